@@ -0,0 +1,207 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+#   python -m app.utils.benchmark --database-url postgresql+psycopg2://... \
+#       --records 1000000 --output bench.json
+#
+# The database must be a disposable one: its data_table is truncated.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def timed(func, repeat: int):
+    """ Runs `func` `repeat` times and summarizes the wall times in ms.
+    `func` returns the number of rows it handled.
+    """
+    times, rows = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    result = {
+        "repeat": repeat,
+        "min_ms": round(times[0], 3),
+        "median_ms": round(statistics.median(times), 3),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+        "rows": rows,
+    }
+    if rows and times[0]:
+        result["rows_per_sec"] = round(rows / (statistics.median(times) / 1000))
+    return result
+
+
+def concurrent(loop, request, clients: int, requests: int):
+    """ Runs `clients` clients at once, each sending `requests` requests one
+    after the other on a session of its own, and summarizes the latencies
+    in ms. `request` takes the session and returns the coroutine to await.
+    """
+    from app.utils import database
+
+    latencies = []
+
+    async def client():
+        db = database.SessionLocal()
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                await request(db)
+                latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            db.close()
+
+    start = time.perf_counter()
+    loop.run_until_complete(asyncio.gather(
+        *(client() for _ in range(clients))))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(latencies[
+            min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+        "max_ms": round(latencies[-1], 3),
+        "requests_per_sec": round(len(latencies) / elapsed),
+    }
+
+
+def run(records: int, repeat: int, seed: int, clients: int, requests: int):
+    # imported here so that --database-url is applied before the engine exists
+    from app.utils import crud, database, dumpCSV, export, migrations, models
+    from app.utils import processing, schemas
+
+    migrations.migrate(database.engine)
+    with database.engine.begin() as conn:
+        conn.exec_driver_sql(
+            f"TRUNCATE {models.Data.__tablename__}, "
+            f"{models.DataKey.__tablename__}, "
+            f"{models.DataRollup.__tablename__}")
+
+    loop = asyncio.new_event_loop()
+    call = loop.run_until_complete
+    db = database.SessionLocal()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.csv")
+        start = time.perf_counter()
+        dumpCSV.data_generate(records, path, seed=seed)
+        results["generate"] = {
+            "rows": records,
+            "seconds": round(time.perf_counter() - start, 3)}
+
+        results["ingest"] = call(crud.upload_data(db, path))
+        results["ingest_upsert_noop"] = call(
+            crud.upload_data(db, path, mode='upsert'))
+
+    def page(page_number, cursor=None):
+        rows, _ = call(crud.paginate_data(page_number, 100, db, cursor=cursor))
+        return len(rows)
+    results["paginate_first"] = timed(lambda: page(1), repeat)
+    results["paginate_offset_deep"] = timed(
+        lambda: page(max(records // 100 - 1, 1)), repeat)
+    _, cursor = call(crud.paginate_data(max(records // 100 - 1, 1), 100, db))
+    results["paginate_cursor_deep"] = timed(lambda: page(1, cursor), repeat)
+
+    sample = db.query(models.Data).first()
+    start_dt = datetime(2000, 1, 1)
+    filters = {
+        "city": schemas.DataFilter(city_name=sample.delivered_to_city),
+        "date": schemas.DataFilter(date_start=start_dt,
+                                   date_end=start_dt + timedelta(days=30)),
+        "total_price": schemas.DataFilter(min_total_price=100,
+                                          max_total_price=110),
+        "quantity": schemas.DataFilter(min_quantity=10, max_quantity=11),
+    }
+    for name, data_filter in filters.items():
+        results[f"filter_by_{name}"] = timed(
+            lambda: len(call(crud.filter_by_parameters(data_filter, db))),
+            repeat)
+
+    # the same reads from many clients at once, through the shared thread
+    # and connection pools
+    workloads = {
+        "paginate_first": lambda session: crud.paginate_data(1, 100, session),
+        "paginate_cursor_deep": lambda session: crud.paginate_data(
+            1, 100, session, cursor=cursor),
+        "filter_by_city": lambda session: crud.filter_by_parameters(
+            filters["city"], session),
+    }
+    for name, request in workloads.items():
+        results[f"concurrent_{name}"] = concurrent(
+            loop, request, clients, requests)
+
+    def stream():
+        query = crud.export_query(db, filters["quantity"])
+        chunks = export.stream_rows(query, crud.DATA_FIELDS, 'csv')
+        return sum(chunk.count("\n") for chunk in chunks) - 1
+    results["export_csv"] = timed(stream, repeat)
+
+    password_hash = processing.get_password_hash("benchmark")
+    results["auth_verify_password"] = timed(
+        lambda: int(processing.verify_password("benchmark", password_hash)),
+        repeat)
+    token = processing.create_access_token({"sub": "benchmark"})
+
+    def decode(cold: bool):
+        if cold:
+            processing.token_cache.clear()
+        processing.decode_access_token(token)
+        return 1
+    results["auth_decode_token_cold"] = timed(lambda: decode(True), repeat)
+    results["auth_decode_token_cached"] = timed(lambda: decode(False), repeat)
+
+    db.close()
+    loop.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the benchmark suite")
+    parser.add_argument("--database-url", required=True,
+                        help="disposable PostgreSQL database to run against")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clients", type=int, default=16,
+                        help="concurrent clients of the concurrent phase")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="requests sent by each concurrent client")
+    parser.add_argument("--output", default="bench.json")
+    args = parser.parse_args()
+
+    os.environ["SQLALCHEMY_DATABASE_URL"] = args.database_url
+    results = run(args.records, args.repeat, args.seed, args.clients,
+                  args.requests)
+    report = {
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "records": args.records,
+        "seed": args.seed,
+        "clients": args.clients,
+        "results": results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    print(f"Benchmark results written to `{args.output}`")
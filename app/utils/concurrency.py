@@ -0,0 +1,98 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils import config, profiling
+
+# Bounded so that blocking work queues here instead of piling up on the
+# database connection pool.
+executor = ThreadPoolExecutor(max_workers=config.BLOCKING_THREADS,
+                              thread_name_prefix="blocking")
+# bcrypt gets its own pool so a burst of logins cannot take every thread
+# away from data queries. The bcrypt library releases the GIL while hashing.
+hashing_executor = ThreadPoolExecutor(max_workers=config.HASHING_THREADS,
+                                      thread_name_prefix="hashing")
+
+
+def _call(func):
+    profile = profiling.current()
+    return func() if profile is None else profile.run(func)
+
+
+async def _run_in(pool: ThreadPoolExecutor, func, *args, **kwargs):
+    # the request context (and so its profile) follows the call to the thread
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        pool, context.run, _call, functools.partial(func, *args, **kwargs))
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ Runs a blocking call (sync SQLAlchemy session, pandas, ...) on the
+    bounded executor so the event loop keeps serving other requests.
+    """
+    return await _run_in(executor, func, *args, **kwargs)
+
+
+async def run_hashing(func, *args, **kwargs):
+    """ Same as `run_blocking`, but on the dedicated password hashing pool.
+    """
+    return await _run_in(hashing_executor, func, *args, **kwargs)
+
+
+class ConcurrencyLimiter:
+    """ Caps how many callers may run a section at once. Callers that cannot
+    get a slot within `timeout` seconds are turned away instead of queueing.
+    """
+
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore = None
+
+    async def acquire(self) -> bool:
+        # created lazily so it binds to the server's running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def release(self):
+        self._semaphore.release()
+
+
+login_limiter = ConcurrencyLimiter(config.LOGIN_CONCURRENCY,
+                                   config.LOGIN_WAIT_TIMEOUT)
+
+
+def offload(func):
+    """ Turns a blocking function into a coroutine function that runs it
+    through `run_blocking`. The original stays available as `__wrapped__`.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    executor.shutdown(wait=False)
+    hashing_executor.shutdown(wait=False)
@@ -0,0 +1,83 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from dotenv import load_dotenv
+
+# every setting is read once, here, at import time
+load_dotenv()
+
+# database
+SQLALCHEMY_DATABASE_URL = str(os.getenv("SQLALCHEMY_DATABASE_URL"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # seconds
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # seconds
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))  # ms, 0 = off
+# range partition data_table by month of transaction_time (new tables only)
+DATA_PARTITIONED = os.getenv("DATA_PARTITIONED", "false").lower() == "true"
+# PgBouncer pools connections itself, so each worker opens them unpooled
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+# false = run `python -m app.utils.migrations` before starting the workers
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP",
+                               "true").lower() == "true"
+
+# read replica, unset = every query goes to the primary
+SQLALCHEMY_REPLICA_URL = os.getenv("SQLALCHEMY_REPLICA_URL")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 0))  # seconds, 0 = off
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+# a client's reads stay on the primary this long after it writes
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+
+# auth
+SECRET_KEY = str(os.getenv("SECRET_KEY"))
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 30))  # seconds
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+
+# profiling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))  # 0..1
+PROFILE_DIR = os.getenv("PROFILE_DIR", "app/data/profiles")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))  # 0 = off
+
+# response cache, RESPONSE_CACHE_SIZE=0 turns it off
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))  # entries
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 300))  # seconds
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY",
+                                        4 * 1024 * 1024))  # bytes
+# directory shared by all workers on the host, unset = local cache only
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")
+RESPONSE_CACHE_VERSION_INTERVAL = float(
+    os.getenv("RESPONSE_CACHE_VERSION_INTERVAL", 1))  # seconds
+
+# ingest validation
+PRICE_TOLERANCE = float(os.getenv("PRICE_TOLERANCE", 0.01))
+QUARANTINE_DIR = os.getenv("QUARANTINE_DIR", "app/data/quarantine")
+
+# background jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))  # jobs running at once
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))  # seconds
+# a running job without a heartbeat for this long is requeued
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", 60))
+JOB_DIR = os.getenv("JOB_DIR", "app/data/jobs")  # export job output
+
+# concurrency
+BLOCKING_THREADS = int(os.getenv("BLOCKING_THREADS", 16))
+HASHING_THREADS = int(os.getenv("HASHING_THREADS", 2))
+LOGIN_CONCURRENCY = int(os.getenv("LOGIN_CONCURRENCY", 4))
+LOGIN_WAIT_TIMEOUT = float(os.getenv("LOGIN_WAIT_TIMEOUT", 2))  # seconds
@@ -12,125 +12,455 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
-import pandas as pd
-import chardet
+from datetime import date, datetime, time
 from uuid import UUID
+from typing import AsyncIterator, List, Optional
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Query, Session
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
-from app.utils import models, schemas, database, processing
+from sqlalchemy import Date, bindparam, cast, func
+from app.utils import models, schemas, pagination, ingest, config, rollups
+from app.utils import metrics, partitions, response_cache, uploads
+from app.utils import dimensions
+from app.utils.cache import TTLCache
+from app.utils.concurrency import offload, run_blocking
+
+# Authenticated users by username. Entries are dropped on every write to
+# admin_user from this worker; the short TTL bounds staleness across workers.
+user_cache = TTLCache(maxsize=1024, ttl=config.AUTH_CACHE_TTL)
+metrics.watch_cache("user", user_cache)
+
+# ids per IN (...) list, well under the bind parameter limit
+BULK_CHUNK_SIZE = 5000
+
+DATA_FIELDS = ['transaction_id', 'transaction_time', 'product_name',
+               'quantity', 'unit_price', 'total_price', 'delivered_to_city']
+# fields stored as ids of a dimension table, and the table holding the name
+DIMENSION_FIELDS = {
+    'product_name': (models.Data.product_id, models.Product.product_id,
+                     models.Product.name),
+    'delivered_to_city': (models.Data.city_id, models.City.city_id,
+                          models.City.name),
+}
+
+
+def field_column(field: str):
+    if field in DIMENSION_FIELDS:
+        return DIMENSION_FIELDS[field][2].label(field)
+    return getattr(models.Data, field)
+
+
+def data_query(db: Session, fields: List[str], joins: List[str] = ()) -> Query:
+    """ Selects `fields` as plain columns, joining in the dimension tables
+    for the city and product names of `fields` and `joins`.
+    """
+    query = db.query(*[field_column(field) for field in fields]) \
+        .select_from(models.Data)
+    for field in set(fields).union(joins) & DIMENSION_FIELDS.keys():
+        foreign_key, key, _ = DIMENSION_FIELDS[field]
+        query = query.outerjoin(key.table, key == foreign_key)
+    return query
+
+
+@offload
+def get_data_by_id(db: Session, transaction_id: UUID):
+    return db.query(models.Data).filter(models.Data.transaction_id == transaction_id).first()
 
 
-async def get_data_by_id(db: Session, transaction_id: UUID):
-    return db.query(models.Data).filter(models.Data.transaction_id == transaction_id).first()
+DUPLICATE_UPLOAD = "IntegrityError: Data already stored in the database!"
+
+
+def _commit_upload(db: Session, stats: dict):
+    conn = db.connection()
+    days = stats.pop("days")
+    rollups.refresh_days(conn, days)
+    # rows updated by an upsert may have moved out of days not in the file
+    rollups.refresh_groups(conn, [
+        key for key in stats.pop("groups")
+        if key[0] is not None and key[0].date() not in days])
+    response_cache.bump(db)
+    db.commit()
+    response_cache.forget_version()
+    metrics.INGEST_ROWS.inc(stats["rows"])
+    metrics.INGEST_SECONDS.inc(stats["seconds"])
 
+    return {"message": "CSV Data successfully uploaded to the database!",
+            **stats}
 
-async def upload_data(db: Session):
 
-    with open('app/data/data.csv', 'rb') as file:
-        result = chardet.detect(file.read())
-    df = pd.read_csv('app/data/data.csv', encoding=result['encoding'])
+@offload
+def upload_data(db: Session, path: str = 'app/data/data.csv',
+                mode: str = 'append', progress=None,
+                invalid: str = 'quarantine'):
     try:
-        df.to_sql('data_table', con=database.engine,
-                  index=False, if_exists='append')
-        db.commit()
+        stats = ingest.load_csv(db.connection(), path, mode=mode,
+                                progress=progress, invalid=invalid)
+        return _commit_upload(db, stats)
     except IntegrityError:
-        return "IntegrityError: Data already stored in the database!"
-
-    return "CSV Data successfully uploaded to the database!"
-
-
-async def update_data(db: Session, data: schemas.DataUpdate, transaction_id: UUID):
-    db.query(models.Data).filter(
-        models.Data.transaction_id == transaction_id). \
-        update(
-            {
-                models.Data.transaction_time: data.transaction_time,
-                models.Data.product_name: data.product_name,
-                models.Data.quantity: data.quantity,
-                models.Data.unit_price: data.unit_price,
-                models.Data.total_price: data.total_price,
-                models.Data.delivered_to_city: data.delivered_to_city
-            }
-    )
-    db.commit()
-    return "Data updated successfully"
+        db.rollback()
+        return DUPLICATE_UPLOAD
+    except Exception:
+        db.rollback()
+        raise
 
 
-async def delete_data(db: Session, transaction_id: UUID):
-    db_data = db.query(models.Data).filter(
-        models.Data.transaction_id == transaction_id).first()
-    db.delete(db_data)
+async def upload_stream(db: Session, chunks: AsyncIterator[bytes],
+                        mode: str = 'append', invalid: str = 'quarantine'):
+    """ Same as `upload_data`, for a csv that is still arriving in `chunks`.
+    """
+    try:
+        stats = await uploads.load_stream(db, chunks, mode, invalid=invalid)
+        return await run_blocking(_commit_upload, db, stats)
+    except IntegrityError:
+        await run_blocking(db.rollback)
+        return DUPLICATE_UPLOAD
+    except Exception:
+        await run_blocking(db.rollback)
+        raise
+
+
+def _existing_keys(db: Session, transaction_ids: List[UUID]):
+    """ Maps each stored id to its rollup key, in chunks of `BULK_CHUNK_SIZE`.
+    """
+    keys = {}
+    for start in range(0, len(transaction_ids), BULK_CHUNK_SIZE):
+        rows = db.query(models.Data.transaction_id,
+                        models.Data.transaction_time,
+                        models.Data.city_id,
+                        models.Data.product_id).filter(
+            models.Data.transaction_id.in_(
+                transaction_ids[start:start + BULK_CHUNK_SIZE]))
+        keys.update((row[0], tuple(row[1:])) for row in rows)
+    return keys
+
+
+@offload
+def bulk_update_data(db: Session, items: List[schemas.DataBulkUpdate]):
+    """ Applies every update with one executemany in a single transaction.
+    Returns the outcome for each item, in order.
+    """
+    old_keys = _existing_keys(
+        db, list({item.transaction_id for item in items}))
+    found = [item for item in items if item.transaction_id in old_keys]
+    if found:
+        conn = db.connection()
+        city_ids = dimensions.cities.ids(
+            conn, {item.delivered_to_city for item in found})
+        product_ids = dimensions.products.ids(
+            conn, {item.product_name for item in found})
+        records = [{"b_transaction_id": item.transaction_id,
+                    **item.dict(exclude={"transaction_id", "product_name",
+                                         "delivered_to_city"}),
+                    "product_id": product_ids[item.product_name],
+                    "city_id": city_ids[item.delivered_to_city]}
+                   for item in found]
+        partitions.ensure_months(conn, (
+            record["transaction_time"].date() for record in records))
+        table = models.Data.__table__
+        db.execute(
+            table.update()
+            .where(table.c.transaction_id == bindparam('b_transaction_id'))
+            .values({column: bindparam(column)
+                     for column in ingest.TABLE_COLUMNS[1:]}),
+            records)
+        new_keys = [(record["transaction_time"], record["city_id"],
+                     record["product_id"]) for record in records]
+        rollups.refresh_groups(db.connection(),
+                               list(old_keys.values()) + new_keys)
+        response_cache.bump(db)
     db.commit()
-    return "Data deleted successfully"
-
-
-async def filter_by_parameters(filter_parameter: str, city_name: str,
-                               range_start: str, range_end: str, db: Session,
-                               save_as_csv: bool):
+    response_cache.forget_version()
+    return [{"transaction_id": item.transaction_id,
+             "status": "updated" if item.transaction_id in old_keys
+             else "not_found"} for item in items]
+
+
+@offload
+def bulk_delete_data(db: Session, transaction_ids: List[UUID]):
+    """ Deletes every row in a single transaction. Returns the outcome for
+    each id, in order.
+    """
+    old_keys = _existing_keys(db, list(set(transaction_ids)))
+    tables = [models.Data.__table__]
+    if partitions.enabled(db.connection()):
+        tables.append(models.DataKey.__table__)
+    found = list(old_keys)
+    for start in range(0, len(found), BULK_CHUNK_SIZE):
+        for table in tables:
+            db.execute(table.delete().where(table.c.transaction_id.in_(
+                found[start:start + BULK_CHUNK_SIZE])))
+    rollups.refresh_groups(db.connection(), old_keys.values())
+    if found:
+        response_cache.bump(db)
+    db.commit()
+    response_cache.forget_version()
+    return [{"transaction_id": transaction_id,
+             "status": "deleted" if transaction_id in old_keys
+             else "not_found"} for transaction_id in transaction_ids]
+
+
+def apply_filters(query: Query, filters: schemas.DataFilter):
+    """ Adds a WHERE clause for every predicate set in `filters`. Each one
+    matches an index on `data_table`.
+    """
+    if filters.city_name is not None:
+        query = query.filter(models.Data.city_id.in_(
+            dimensions.cities.lookup(filters.city_name, lower=True)))
+    if filters.product_name is not None:
+        query = query.filter(models.Data.product_id.in_(
+            dimensions.products.lookup(filters.product_name)))
+    ranges = [
+        (models.Data.transaction_time, filters.date_start, filters.date_end),
+        (models.Data.total_price, filters.min_total_price,
+         filters.max_total_price),
+        (models.Data.quantity, filters.min_quantity, filters.max_quantity),
+    ]
+    for column, start, end in ranges:
+        if start is not None:
+            query = query.filter(column >= start)
+        if end is not None:
+            query = query.filter(column <= end)
+    return query
+
+
+@offload
+def query_data(db: Session, filters: schemas.DataFilter,
+               fields: List[str] = DATA_FIELDS,
+               sort_by: str = 'transaction_time', descending: bool = False,
+               limit: int = 1000):
+    """ Runs any combination of filters as one statement, selecting only the
+    requested columns.
+    """
+    sort_column = DIMENSION_FIELDS[sort_by][2] \
+        if sort_by in DIMENSION_FIELDS else getattr(models.Data, sort_by)
+    order = [sort_column, models.Data.transaction_id]
+    if descending:
+        order = [column.desc() for column in order]
+
+    # the sort field is joined in even when it is not returned
+    query = apply_filters(data_query(db, fields, joins=[sort_by]), filters)
+    rows = query.order_by(*order).limit(limit).all()
+    metrics.ROWS_RETURNED.labels("query").observe(len(rows))
+    return [dict(row._mapping) for row in rows]
+
+
+def parse_filter_parameters(filter_parameter: str, city_name: str,
+                            range_start: str, range_end: str):
+    """ Translates the single filter of `/data/filter_by` into a
+    `DataFilter`. Returns None for an unknown filter and raises ValueError
+    when the parameters for the chosen filter are missing or malformed.
+    """
     dt_format = "%Y%m%d %H%M%S"
     try:
-        range_start_dt = datetime.strptime(range_start, dt_format)
-        range_end_dt = datetime.strptime(range_end, dt_format)
-    except (ValueError, TypeError):
-        range_start_dt = None
-        range_end_dt = None
-
-    if filter_parameter == 'city':
-        result = db.query(models.Data).filter(
-            func.lower(models.Data.delivered_to_city) == city_name.lower()).all()
-    elif filter_parameter == 'date':
-        result = db.query(models.Data).filter(
-            models.Data.transaction_time.between(range_start_dt, range_end_dt)).all()
-    elif filter_parameter == 'total_price':
-        result = db.query(models.Data).filter(
-            models.Data.total_price.between(range_start_dt, range_end_dt)).all()
-    elif filter_parameter == 'quantity':
-        result = db.query(models.Data).filter(
-            models.Data.quantity.between(range_start_dt, range_end_dt)).all()
+        if filter_parameter == 'city':
+            if city_name is None:
+                raise ValueError("city_name is required")
+            return schemas.DataFilter(city_name=city_name)
+        elif filter_parameter == 'date':
+            return schemas.DataFilter(
+                date_start=datetime.strptime(range_start, dt_format),
+                date_end=datetime.strptime(range_end, dt_format))
+        elif filter_parameter == 'total_price':
+            return schemas.DataFilter(min_total_price=float(range_start),
+                                      max_total_price=float(range_end))
+        elif filter_parameter == 'quantity':
+            return schemas.DataFilter(min_quantity=int(range_start),
+                                      max_quantity=int(range_end))
+    except TypeError:
+        raise ValueError("range_start and range_end are required")
+    return None
+
+
+@offload
+def filter_by_parameters(filters: schemas.DataFilter, db: Session):
+    result = apply_filters(db.query(models.Data), filters).all()
+    metrics.ROWS_RETURNED.labels("filter_by").observe(len(result))
+    return [schemas.Data.from_orm(row) for row in result]
+
+
+def export_query(db: Session, filters: schemas.DataFilter,
+                 fields: List[str] = DATA_FIELDS):
+    """ Builds, without running it, the query streamed by `export.stream_rows`.
+    """
+    return apply_filters(data_query(db, fields), filters) \
+        .order_by(models.Data.transaction_time, models.Data.transaction_id)
+
+
+@offload
+def data_stats(db: Session, group_by: str,
+               date_start: Optional[date] = None,
+               date_end: Optional[date] = None,
+               city_name: Optional[str] = None,
+               product_name: Optional[str] = None,
+               percentiles: Optional[List[float]] = None):
+    """ Aggregates `data_rollup` by city, product or time bucket. Percentiles
+    cannot be rolled up, so when asked for they are computed from
+    `data_table` for the same groups.
+    """
+    rollup = models.DataRollup
+    key = _stats_key(rollup.day, group_by)
+    query = _join_stats_key(db.query(
+        key.label('key'),
+        func.sum(rollup.row_count).label('count'),
+        func.sum(rollup.quantity_sum).label('sum_quantity'),
+        func.sum(rollup.total_price_sum).label('sum_total_price')),
+        rollup, group_by)
+    if date_start is not None:
+        query = query.filter(rollup.day >= date_start)
+    if date_end is not None:
+        query = query.filter(rollup.day <= date_end)
+    if city_name is not None:
+        query = query.filter(rollup.city_id.in_(
+            dimensions.cities.lookup(city_name, lower=True)))
+    if product_name is not None:
+        query = query.filter(rollup.product_id.in_(
+            dimensions.products.lookup(product_name)))
+
+    result = {}
+    for row in query.group_by(key).order_by(key):
+        result[row.key] = {
+            group_by: row.key,
+            "count": row.count,
+            "sum_quantity": row.sum_quantity,
+            "avg_quantity": row.sum_quantity / row.count,
+            "sum_total_price": row.sum_total_price,
+            "avg_total_price": row.sum_total_price / row.count,
+        }
+
+    if percentiles:
+        data_key = _stats_key(
+            cast(models.Data.transaction_time, Date), group_by)
+        columns = [data_key.label('key')]
+        for p in percentiles:
+            for name in ('quantity', 'total_price'):
+                columns.append(func.percentile_cont(p).within_group(
+                    getattr(models.Data, name)).label(f"p{p * 100:g}_{name}"))
+        filters = schemas.DataFilter(
+            city_name=city_name, product_name=product_name,
+            date_start=datetime.combine(date_start, time.min)
+            if date_start else None,
+            date_end=datetime.combine(date_end, time.max)
+            if date_end else None)
+        query = _join_stats_key(db.query(*columns), models.Data, group_by)
+        query = apply_filters(query, filters).group_by(data_key)
+        for row in query:
+            if row.key in result:
+                result[row.key].update(
+                    (name, value) for name, value in row._mapping.items()
+                    if name != 'key')
+
+    return list(result.values())
+
+
+def _stats_key(day, group_by: str):
+    if group_by == 'city':
+        return models.City.name
+    if group_by == 'product_name':
+        return models.Product.name
+    if group_by == 'day':
+        return day
+    return cast(func.date_trunc(group_by, day), Date)  # month, year
+
+
+def _join_stats_key(query: Query, table, group_by: str):
+    # the dimension tables give the names of the city and product groups
+    query = query.select_from(table)
+    if group_by == 'city':
+        return query.join(models.City, models.City.city_id == table.city_id)
+    if group_by == 'product_name':
+        return query.join(models.Product,
+                          models.Product.product_id == table.product_id)
+    return query
+
+
+@offload
+def paginate_data(page: int, entries_per_page: int, db: Session,
+                  cursor: Optional[str] = None, orm: bool = True):
+    """ Returns one page of rows along with the cursor for the next page.
+
+    Shallow pages use LIMIT/OFFSET; passing `cursor` switches to keyset
+    pagination, which stays cheap no matter how deep the page is. With
+    `orm=False` the rows are plain tuples in `DATA_FIELDS` order instead of
+    `models.Data` instances, which skips identity map bookkeeping.
+    """
+    query = db.query(models.Data) if orm else data_query(db, DATA_FIELDS)
+    query = pagination.keyset_order(query)
+    if cursor:
+        query = pagination.keyset_after(query, cursor)
     else:
-        return "Data not found!"
-
-    if save_as_csv:
-        processing.sql_query_to_csv(result)
-    return result
-
-
-async def paginate_data(page: int, entries_per_page: int, db: Session):
-    all_rows = db.query(models.Data).all()
-    output = [all_rows[i:i + entries_per_page]
-              for i in range(0, len(all_rows), entries_per_page)]
-
-    return output[page-1]  # index starts from 0
+        query = query.offset((page - 1) * entries_per_page)  # page starts at 1
+    rows = query.limit(entries_per_page).all()
+    metrics.ROWS_RETURNED.labels("all").observe(len(rows))
+
+    next_cursor = None
+    if len(rows) == entries_per_page:
+        next_cursor = pagination.encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+@offload
+def drop_data_before(db: Session, cutoff: date, detach: bool = False):
+    """ Removes whole monthly partitions that end on or before `cutoff`,
+    along with their rollup rows.
+    """
+    conn = db.connection()
+    removed = partitions.drop_before(conn, cutoff, detach=detach)
+    if removed:
+        # only rows left in the default partition remain before this month
+        rollups.refresh_before(conn, cutoff.replace(day=1))
+        response_cache.bump(db)
+    db.commit()
+    response_cache.forget_version()
+    return {"detached" if detach else "dropped": removed}
 
 
-async def get_users(db: Session, skip: int = 0, limit: int = 100):
+@offload
+def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.AdminUser).offset(skip).limit(limit).all()
 
 
-async def get_user_by_id(db: Session, id: int):
+@offload
+def get_user_by_id(db: Session, id: int):
     return db.query(models.AdminUser).filter(models.AdminUser.user_id == id).first()
 
 
-async def get_user_by_username(db: Session, username: str):
+@offload
+def get_user_by_username(db: Session, username: str):
     return db.query(models.AdminUser).filter(models.AdminUser.username == username).first()
 
 
-async def create_admin_user(db: Session, user: schemas.AdminUserCreate,
-                            password: schemas.AdminUserCreate):
+async def get_auth_user(db: Session, username: str):
+    """ Returns the `AdminUserInDB` used for authentication, served from
+    `user_cache` when possible.
+    """
+    user = user_cache.get(username)
+    if user is None:
+        db_user = await get_user_by_username(db, username=username)
+        if db_user is None:
+            return None
+        user = schemas.AdminUserInDB(username=db_user.username,
+                                     password=db_user.password,
+                                     disabled=bool(db_user.disabled))
+        user_cache.set(username, user)
+    return user
+
+
+@offload
+def create_admin_user(db: Session, user: schemas.AdminUserCreate,
+                      password: schemas.AdminUserCreate):
 
     db_user = models.AdminUser(
         username=user.username, password=password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    user_cache.pop(user.username)
     return db_user
 
 
-async def update_admin_user(db: Session, user: schemas.AdminUserCreate,
-                            password: schemas.AdminUserCreate):
+@offload
+def update_admin_user(db: Session, user: schemas.AdminUserCreate,
+                      password: schemas.AdminUserCreate):
 
     db_user = models.AdminUser(
         username=user.username, password=password)
@@ -138,13 +468,16 @@ async def update_admin_user(db: Session, user: schemas.AdminUserCreate,
         models.AdminUser.username == db_user.username) \
         .update({models.AdminUser.password: db_user.password})
     db.commit()
+    user_cache.pop(user.username)
     return "User updated successfully"
 
 
-async def delete_admin_user(db: Session, user: schemas.AdminUserDelete):
+@offload
+def delete_admin_user(db: Session, user: schemas.AdminUserDelete):
 
     db_user = db.query(models.AdminUser).filter(
         models.AdminUser.username == user.username).first()
     db.delete(db_user)
     db.commit()
+    user_cache.pop(user.username)
     return "User deleted successfully"
@@ -12,15 +12,238 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from sqlalchemy import create_engine
+import hashlib
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
-import os
+from sqlalchemy.pool import NullPool, QueuePool
+from app.utils import config
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger("app.database")
+
+
+class PoolStats:
+    """ Checkout wait times of one of this worker's connection pools.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.timeouts += timed_out
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records in `stats` how long each checkout waited for a
+    connection. Each engine has its own pool, and so its own stats.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        # dispose() swaps in a fresh pool, the figures carry over to it
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
 
-load_dotenv()
-SQLALCHEMY_DATABASE_URL = str(os.getenv("SQLALCHEMY_DATABASE_URL"))
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except Exception:
+            timed_out = True
+            raise
+        finally:
+            self.stats.record(time.perf_counter() - start, timed_out)
+
+
+def engine_options(url: str, pool_size: int = None, max_overflow: int = None):
+    options = {}
+    is_psycopg2 = make_url(url).get_driver_name() == 'psycopg2'
+    if is_psycopg2:
+        # send UPDATE/DELETE executemany in pages instead of one statement
+        # per row
+        options["executemany_mode"] = "values_plus_batch"
+
+    if config.DB_PGBOUNCER:
+        # psycopg2 never uses server-side prepared statements, so only the
+        # pooling has to be left to PgBouncer
+        options["poolclass"] = NullPool
+        return options
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=config.DB_POOL_SIZE if pool_size is None else pool_size,
+        max_overflow=config.DB_MAX_OVERFLOW if max_overflow is None
+        else max_overflow,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+    )
+    if is_psycopg2 and config.DB_STATEMENT_TIMEOUT:
+        # a startup option; PgBouncer would reject it, hence set only here
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config.DB_STATEMENT_TIMEOUT}"}
+    return options
+
+
+engine = create_engine(config.SQLALCHEMY_DATABASE_URL,
+                       **engine_options(config.SQLALCHEMY_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# `app.utils.dimensions` commits new names on a second connection while the
+# caller still holds one of `engine`; taking both from the same pool could
+# leave every thread holding one and waiting for another. Its inserts are
+# short, so a small pool of its own is enough.
+DIMENSION_POOL_SIZE = 2
+dimension_engine = create_engine(
+    config.SQLALCHEMY_DATABASE_URL,
+    **engine_options(config.SQLALCHEMY_DATABASE_URL,
+                     pool_size=DIMENSION_POOL_SIZE, max_overflow=0))
+
+replica_engine = None
+ReplicaSessionLocal = None
+if config.SQLALCHEMY_REPLICA_URL:
+    replica_engine = create_engine(
+        config.SQLALCHEMY_REPLICA_URL,
+        **engine_options(config.SQLALCHEMY_REPLICA_URL))
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False,
+                                       bind=replica_engine)
+
 Base = declarative_base()
+
+
+class ReplicaHealth:
+    """ Whether the replica may serve reads: it answers and, with
+    `REPLICA_MAX_LAG` set, its replay lag is within the bound. Checked at
+    most every `REPLICA_CHECK_INTERVAL` seconds; while one thread checks,
+    the others keep the previous answer.
+    """
+
+    def __init__(self):
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def _lag(self, conn):
+        if conn.dialect.name != 'postgresql':
+            return 0.0
+        # zero when everything received has been replayed, so an idle
+        # primary does not look like lag; NULL (not a standby) counts as zero
+        return conn.execute(text(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = "
+            "pg_last_wal_replay_lsn() THEN 0 ELSE COALESCE(EXTRACT(EPOCH "
+            "FROM now() - pg_last_xact_replay_timestamp()), 0) END")).scalar()
+
+    def check(self):
+        try:
+            with replica_engine.connect() as conn:
+                lag = float(self._lag(conn) or 0.0)
+        except Exception as e:
+            if self.healthy or self.checked_at is None:
+                logger.warning("replica unavailable, reading from the "
+                               "primary: %s", e)
+            self.healthy, self.lag = False, None
+        else:
+            self.lag = lag
+            self.healthy = not config.REPLICA_MAX_LAG or \
+                lag <= config.REPLICA_MAX_LAG
+        self.checked_at = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        if replica_engine is None:
+            return False
+        due = self.checked_at is None or \
+            time.monotonic() - self.checked_at >= config.REPLICA_CHECK_INTERVAL
+        if due and self._lock.acquire(blocking=self.checked_at is None):
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+        return self.healthy
+
+
+replica_health = ReplicaHealth()
+
+# clients, by a digest of their credentials, that wrote recently
+recent_writers = TTLCache(maxsize=10000, ttl=config.READ_YOUR_WRITES_SECONDS)
+
+
+def client_key(credentials: str) -> bytes:
+    return hashlib.sha256(credentials.encode()).digest()
+
+
+def note_write(credentials: str):
+    recent_writers.set(client_key(credentials), True)
+
+
+def read_session():
+    """ A session on the replica when it is healthy, otherwise on the
+    primary. For reads that may lag behind the latest writes.
+    """
+    if replica_health.is_healthy():
+        return ReplicaSessionLocal()
+    return SessionLocal()
+
+
+def read_session_for(credentials: str):
+    # a client that just wrote reads its own writes from the primary
+    if recent_writers.get(client_key(credentials)) is not None:
+        return SessionLocal()
+    return read_session()
+
+
+def pool_status():
+    """ Utilization and checkout waits of this worker's pools, the
+    dimension and replica ones reported separately.
+    """
+    status = _pool_report(engine.pool)
+    status["dimensions"] = _pool_report(dimension_engine.pool)
+    if replica_engine is not None:
+        status["replica"] = {
+            **_pool_report(replica_engine.pool),
+            "healthy": replica_health.healthy,
+            "lag": replica_health.lag,
+        }
+    return status
+
+
+def _pool_report(pool):
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + pool._max_overflow
+        status.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            utilization=round(pool.checkedout() / capacity, 3)
+            if capacity else 0,
+        )
+    stats = getattr(pool, "stats", None) or PoolStats()
+    status.update(
+        checkouts=stats.checkouts,
+        checkout_timeouts=stats.timeouts,
+        checkout_wait_avg=stats.wait_total / stats.checkouts
+        if stats.checkouts else 0.0,
+        checkout_wait_max=stats.wait_max,
+    )
+    return status
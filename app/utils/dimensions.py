@@ -0,0 +1,88 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from typing import Dict, Iterable
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+
+from app.utils import database, models
+
+# names per IN (...) list when looking up ids
+LOOKUP_CHUNK_SIZE = 1000
+
+
+class Dimension:
+    """ Name to id map of a dimension table, filled on demand. Ids never
+    change once assigned, so the cached entries never go stale.
+    """
+
+    def __init__(self, model, id_column: str):
+        self.table = model.__table__
+        self.id_column = self.table.c[id_column]
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _insert_missing(self, conn: Connection, names: list):
+        conn.execute(pg_insert(self.table).on_conflict_do_nothing(
+            index_elements=['name']), [{"name": name} for name in names])
+
+    def ids(self, conn: Connection, names: Iterable[str]) -> Dict[str, int]:
+        """ Maps every name to its id, adding the names that are missing.
+        New names are committed on a connection of their own, taken from
+        `database.dimension_engine`, so their ids stay valid even if the
+        caller's transaction rolls back.
+        """
+        names = set(names)
+        missing = sorted(names - self._ids.keys())
+        if missing:
+            # the caller's transaction may not see rows committed after it
+            # started, so the lookup runs on the new connection too
+            with database.dimension_engine.begin() as own:
+                for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+                    batch = missing[start:start + LOOKUP_CHUNK_SIZE]
+                    self._insert_missing(own, batch)
+                    rows = own.execute(select(
+                        self.table.c.name, self.id_column).where(
+                        self.table.c.name.in_(batch)))
+                    with self._lock:
+                        self._ids.update(tuple(row) for row in rows)
+        return {name: self._ids[name] for name in names}
+
+    def encode(self, conn: Connection, values: pd.Series) -> np.ndarray:
+        """ Replaces a column of names by their ids, resolving each distinct
+        name once.
+        """
+        values = values.astype('category')
+        categories = values.cat.categories
+        mapping = self.ids(conn, categories)
+        ids = np.array([mapping[name] for name in categories], dtype=np.int64)
+        return ids[values.cat.codes.to_numpy()]
+
+    def lookup(self, name: str, lower: bool = False):
+        """ Subquery of the ids matching `name`, to filter on without joining.
+        """
+        column = self.table.c.name
+        if lower:
+            return select(self.id_column).where(
+                func.lower(column) == name.lower())
+        return select(self.id_column).where(column == name)
+
+
+cities = Dimension(models.City, 'city_id')
+products = Dimension(models.Product, 'product_id')
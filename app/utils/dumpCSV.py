@@ -12,35 +12,126 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import csv
+import argparse
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 from faker import Faker  # generates fake data
-import datetime
-import uuid
-import random
+
+HEADERS = ['transaction_id', 'transaction_time', 'product_name',
+           'quantity', 'unit_price', 'total_price', 'delivered_to_city']
+START_TIME = np.datetime64('1970-01-01T00:00:00', 's')
+END_TIME = np.datetime64('2021-01-01T00:00:00', 's')
+# the two ascii hex digits of every byte value, as a (256, 2) matrix
+HEX_PAIRS = np.frombuffer(
+    "".join(f"{i:02x}" for i in range(256)).encode(), dtype=np.uint8) \
+    .reshape(256, 2)
+UUID_DASHES = [8, 13, 18, 23]
+UUID_HEX = [i for i in range(36) if i not in UUID_DASHES]
 
 
-def data_generate(records, headers):
+def vocabulary(seed: int, size: int = 500):
+    """ Draws the city and product names once with Faker, rows then only
+    pick from these lists.
+    """
     fake = Faker('en_IN')
-    with open("app/data/data.csv", 'wt') as csvFile:
-        writer = csv.DictWriter(csvFile, fieldnames=headers)
-        writer.writeheader()
-        for _ in range(records):
-            quantity = random.randint(1, 100)
-            unit_price = random.uniform(2.25, 55.75)
-            writer.writerow({
-                'transaction_id': uuid.uuid4(),
-                'transaction_time': fake.date(pattern="%Y%m%d %H%M%S", end_datetime=datetime.date(2021, 1, 1)),
-                'product_name': fake.word(),
-                'quantity': quantity,
-                'unit_price': unit_price,
-                'total_price': quantity*unit_price,
-                'delivered_to_city': fake.city()
-            })
+    fake.seed_instance(seed)
+    cities = sorted({fake.city() for _ in range(size)})
+    products = sorted({fake.word() for _ in range(size)})
+    return np.array(cities), np.array(products)
+
+
+def random_uuids(rng: np.random.Generator, n: int):
+    """ Version 4 uuid strings built from random bytes without a Python loop:
+    the hex digits are written into a fixed-width ascii matrix, which is then
+    read as one 36 character string per row.
+    """
+    raw = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40  # version
+    raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80  # variant
+    text = np.full((n, 36), ord('-'), dtype=np.uint8)
+    text[:, UUID_HEX] = HEX_PAIRS[raw].reshape(n, 32)
+    return text.view('S36').ravel().astype('U36')
+
+
+def _digits(values: np.ndarray, width: int):
+    """ The zero padded decimal digits of `values`, as ascii codes.
+    """
+    places = 10 ** np.arange(width - 1, -1, -1)
+    return (values[:, None] // places % 10 + ord('0')).astype(np.uint8)
+
+
+def random_times(rng: np.random.Generator, n: int):
+    """ Timestamps formatted as `%Y%m%d %H%M%S`, built with integer
+    arithmetic into a fixed-width ascii matrix instead of strftime.
+    """
+    span = (END_TIME - START_TIME).astype(int)
+    times = START_TIME + rng.integers(0, span, size=n).astype('timedelta64[s]')
+    days = times.astype('datetime64[D]')
+    months = times.astype('datetime64[M]')
+    years = times.astype('datetime64[Y]').astype(int) + 1970
+    ymd = years * 10000 + (months.astype(int) % 12 + 1) * 100 + \
+        (days - months).astype(int) + 1
+    seconds = (times - days).astype(int)
+    hms = seconds // 3600 * 10000 + seconds % 3600 // 60 * 100 + seconds % 60
+    text = np.empty((n, 15), dtype=np.uint8)
+    text[:, :8] = _digits(ymd, 8)
+    text[:, 8] = ord(' ')
+    text[:, 9:] = _digits(hms, 6)
+    return text.view('S15').ravel().astype('U15')
+
+
+def generate_part(args):
+    path, records, seed, cities, products = args
+    rng = np.random.default_rng(seed)
+    quantity = rng.integers(1, 101, size=records)
+    unit_price = rng.uniform(2.25, 55.75, size=records)
+    pd.DataFrame({
+        'transaction_id': random_uuids(rng, records),
+        'transaction_time': random_times(rng, records),
+        'product_name': products[rng.integers(0, len(products), records)],
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'total_price': quantity * unit_price,
+        'delivered_to_city': cities[rng.integers(0, len(cities), records)],
+    }, columns=HEADERS).to_csv(path, index=False, header=False)
+    return path
+
+
+def data_generate(records: int, path: str = "app/data/data.csv",
+                  seed: int = 0, workers: int = os.cpu_count() or 1,
+                  part_size: int = 1000000):
+    """ Writes `records` fake rows to `path`. Parts of `part_size` rows are
+    generated in parallel and the output only depends on `seed`.
+    """
+    cities, products = vocabulary(seed)
+    sizes = [min(part_size, records - start)
+             for start in range(0, records, part_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = [(os.path.join(tmp, f"part-{i}.csv"), size, seeds[i],
+                 cities, products) for i, size in enumerate(sizes)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(generate_part, jobs))
+        with open(path, 'w') as csvFile:
+            csvFile.write(','.join(HEADERS) + '\n')
+            for part in parts:
+                with open(part) as partFile:
+                    shutil.copyfileobj(partFile, csvFile)
 
 
 if __name__ == '__main__':
-    records = 1000
-    headers = ['transaction_id', 'transaction_time', 'product_name',
-               'quantity', 'unit_price', 'total_price', 'delivered_to_city']
-    data_generate(records, headers)
-    print("CSV generated at `app/data/data.csv`")
+    parser = argparse.ArgumentParser(description="Generate fake data.csv")
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--output", default="app/data/data.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    data_generate(args.records, args.output, seed=args.seed,
+                  workers=args.workers)
+    print(f"CSV generated at `{args.output}`")
@@ -0,0 +1,176 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import io
+import json
+from itertools import islice
+from typing import Callable, Iterable, List, Optional
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.orm import Query
+
+EXPORT_MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+CHUNK_ROWS = 1000
+ARROW_CHUNK_ROWS = 65536  # rows per record batch / parquet row group
+
+# low-cardinality text columns are dictionary encoded
+ARROW_TYPES = {
+    'transaction_id': pa.string(),
+    'transaction_time': pa.timestamp('us'),
+    'product_name': pa.dictionary(pa.int32(), pa.string()),
+    'quantity': pa.int32(),
+    'unit_price': pa.float64(),
+    'total_price': pa.float64(),
+    'delivered_to_city': pa.dictionary(pa.int32(), pa.string()),
+}
+
+
+def encode_rows(fields: List[str], rows, columnar: bool = False) -> bytes:
+    """ Encodes row tuples straight to JSON with orjson, which handles the
+    UUID, datetime and float columns natively. `columnar` returns one array
+    per column instead of one object per row.
+    """
+    if columnar:
+        columns = list(zip(*rows)) or [()] * len(fields)
+        return orjson.dumps(
+            {field: list(values) for field, values in zip(fields, columns)})
+    return orjson.dumps([dict(zip(fields, row)) for row in rows])
+
+
+class _ChunkSink:
+    """ Write-only file object whose content is drained after every batch,
+    so the writers never hold more than one batch of output.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_batch(fields: List[str], rows) -> pa.RecordBatch:
+    columns = list(zip(*rows)) or [()] * len(fields)
+    arrays = []
+    for field, values in zip(fields, columns):
+        if field == 'transaction_id':
+            values = [str(value) for value in values]
+        arrow_type = ARROW_TYPES[field]
+        if pa.types.is_dictionary(arrow_type):
+            arrays.append(pa.array(values, type=arrow_type.value_type)
+                          .dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=arrow_type))
+    return pa.RecordBatch.from_arrays(arrays, names=fields)
+
+
+def stream_arrow(fields: List[str], row_batches: Iterable, format: str):
+    """ Yields `row_batches` encoded as an Arrow IPC stream or a Parquet file,
+    one record batch (or row group) at a time. Each batch carries its own
+    dictionaries.
+    """
+    schema = pa.schema([(field, ARROW_TYPES[field]) for field in fields])
+    sink = _ChunkSink()
+    if format == 'arrow':
+        writer = pa.ipc.new_stream(sink, schema)
+    else:
+        writer = pq.ParquetWriter(sink, schema)
+    for rows in row_batches:
+        batch = arrow_batch(fields, rows)
+        if format == 'arrow':
+            writer.write_batch(batch)
+        else:
+            writer.write_table(pa.Table.from_batches([batch], schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _query_batches(query: Query, size: int, progress=None):
+    rows = iter(query.yield_per(size))
+    total = 0
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        total += len(batch)
+        if progress:
+            progress(total)
+        yield batch
+
+
+def _ndjson_default(value):
+    # UUID and datetime columns
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def stream_rows(query: Query, fields: List[str], format: str,
+                chunk_rows: int = CHUNK_ROWS,
+                progress: Optional[Callable[[int], None]] = None):
+    """ Yields the query result encoded as csv, ndjson, parquet or arrow,
+    `chunk_rows` rows at a time (`ARROW_CHUNK_ROWS` for the binary formats).
+    Rows are fetched through a server-side cursor, so memory use stays flat
+    no matter how many rows are exported. `progress` is called with the
+    running row count before every chunk.
+    """
+    if format in ('parquet', 'arrow'):
+        yield from stream_arrow(
+            fields, _query_batches(query, ARROW_CHUNK_ROWS, progress), format)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if format == 'csv' else None
+    if writer:
+        writer.writerow(fields)
+
+    number = 0
+    for number, row in enumerate(query.yield_per(chunk_rows), start=1):
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row)),
+                                    default=_ndjson_default))
+            buffer.write("\n")
+        if number % chunk_rows == 0:
+            if progress:
+                progress(number)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        if progress:
+            progress(number)
+        yield buffer.getvalue()
@@ -0,0 +1,332 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+import chardet
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from app.utils import dimensions, models, partitions, validation
+
+DATA_COLUMNS = ['transaction_id', 'transaction_time', 'product_name',
+                'quantity', 'unit_price', 'total_price', 'delivered_to_city']
+# the names are stored as ids of the city and product dimension tables
+# read as plain strings; the C parser types the numeric columns itself,
+# which is far cheaper than converting them in `validation`
+TEXT_COLUMNS = {column: str for column in DATA_COLUMNS
+                if column not in ('quantity', 'unit_price', 'total_price')}
+TABLE_COLUMNS = ['transaction_id', 'transaction_time', 'product_id',
+                 'quantity', 'unit_price', 'total_price', 'city_id']
+ENCODING_SAMPLE_SIZE = 64 * 1024  # bytes
+CHUNK_SIZE = 50000  # rows
+INGEST_MODES = ('append', 'upsert', 'ignore')
+STAGING_TABLE = 'data_table_staging'
+
+
+def sniff_encoding(sample: bytes):
+    result = chardet.detect(sample)
+    # an all-ascii prefix is also valid utf-8, which is the safer guess
+    # for whatever follows it
+    if result['encoding'] in (None, 'ascii'):
+        return 'utf-8'
+    return result['encoding']
+
+
+def detect_encoding(path: str, sample_size: int = ENCODING_SAMPLE_SIZE):
+    """ Guesses the file encoding from a bounded prefix instead of the whole file.
+    """
+    with open(path, 'rb') as file:
+        return sniff_encoding(file.read(sample_size))
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE):
+    """ Yields the csv as DataFrames, at most `chunk_size` rows each. Only
+    the numeric columns are typed by the parser, and only when every value
+    of the chunk parses; `validation` does the remaining conversion.
+    """
+    encoding = detect_encoding(path)
+    for chunk in pd.read_csv(path, encoding=encoding, chunksize=chunk_size,
+                             usecols=DATA_COLUMNS, dtype=TEXT_COLUMNS):
+        yield chunk[DATA_COLUMNS]
+
+
+def parse_csv(data: bytes, encoding: str = 'utf-8'):
+    """ Parses an in-memory csv block, header included, like `read_chunks`.
+    """
+    chunk = pd.read_csv(io.BytesIO(data), encoding=encoding,
+                        usecols=DATA_COLUMNS, dtype=TEXT_COLUMNS)
+    return chunk[DATA_COLUMNS]
+
+
+def encode_dimensions(conn: Connection, chunk: pd.DataFrame):
+    """ Swaps the city and product names of a validated chunk for their
+    dimension ids, returning the chunk in `TABLE_COLUMNS` order.
+    """
+    return chunk.assign(
+        product_id=dimensions.products.encode(conn, chunk['product_name']),
+        city_id=dimensions.cities.encode(conn, chunk['delivered_to_city']),
+    )[TABLE_COLUMNS]
+
+
+def copy_chunk(conn: Connection, chunk: pd.DataFrame,
+               table: str = models.Data.__tablename__):
+    """ Loads a chunk through PostgreSQL `COPY FROM STDIN`.
+    """
+    buffer = io.StringIO()
+    chunk.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    statement = f"COPY {table} " \
+        f"({', '.join(chunk.columns)}) FROM STDIN WITH (FORMAT csv)"
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    except conn.dialect.dbapi.IntegrityError as e:
+        # raw DBAPI cursors bypass SQLAlchemy's exception wrapping
+        raise IntegrityError(statement, None, e)
+    finally:
+        cursor.close()
+
+
+def copy_keys(conn: Connection, chunk: pd.DataFrame):
+    """ Adds the ids of a chunk to `data_key` when `data_table` is
+    partitioned; an id that is already stored raises `IntegrityError`.
+    """
+    if partitions.enabled(conn):
+        copy_chunk(conn, chunk[['transaction_id']],
+                   table=models.DataKey.__tablename__)
+
+
+def _stage(conn: Connection, chunk: pd.DataFrame):
+    conn.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} "
+        f"(LIKE {models.Data.__tablename__} INCLUDING DEFAULTS) "
+        f"ON COMMIT DROP"))
+    conn.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+    copy_chunk(conn, chunk, table=STAGING_TABLE)
+
+
+def _distinct_from_staged(alias: str):
+    stored = ', '.join(f"{alias}.{c}" for c in TABLE_COLUMNS[1:])
+    staged = ', '.join(f"{STAGING_TABLE}.{c}" for c in TABLE_COLUMNS[1:])
+    return f"({stored}) IS DISTINCT FROM ({staged})"
+
+
+def _changed_groups(conn: Connection):
+    """ Rollup keys, as (day, city_id, product_id) with the day as a datetime,
+    of the stored rows that the staged chunk is about to change.
+    """
+    rows = conn.execute(text(
+        f"SELECT DISTINCT CAST(stored.transaction_time AS DATE), "
+        f"stored.city_id, stored.product_id "
+        f"FROM {models.Data.__tablename__} AS stored JOIN {STAGING_TABLE} "
+        f"ON stored.transaction_id = {STAGING_TABLE}.transaction_id "
+        f"WHERE {_distinct_from_staged('stored')}"))
+    return {(datetime.combine(day, datetime.min.time()), city, product)
+            for day, city, product in rows if day is not None}
+
+
+def upsert_chunk_pg(conn: Connection, chunk: pd.DataFrame, mode: str):
+    """ Copies a chunk into a temporary staging table, then merges it into
+    `data_table` with a single `INSERT ... ON CONFLICT`. Rows identical to the
+    stored ones are left untouched. Besides the counts, returns as `groups`
+    the rollup keys the updated rows had before.
+    """
+    if partitions.enabled(conn):
+        return upsert_chunk_partitioned(conn, chunk, mode)
+    table = models.Data.__tablename__
+    _stage(conn, chunk)
+
+    columns = ', '.join(TABLE_COLUMNS)
+    groups = set()
+    if mode == 'upsert':
+        groups = _changed_groups(conn)
+        updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in TABLE_COLUMNS[1:])
+        stored = ', '.join(f"{table}.{c}" for c in TABLE_COLUMNS[1:])
+        excluded = ', '.join(f"EXCLUDED.{c}" for c in TABLE_COLUMNS[1:])
+        on_conflict = f"DO UPDATE SET {updates} " \
+            f"WHERE ({stored}) IS DISTINCT FROM ({excluded})"
+    else:
+        on_conflict = "DO NOTHING"
+
+    # DISTINCT ON keeps a single row per key, ON CONFLICT cannot touch
+    # the same row twice within one statement
+    result = conn.execute(text(
+        f"INSERT INTO {table} ({columns}) "
+        f"SELECT DISTINCT ON (transaction_id) {columns} FROM {STAGING_TABLE} "
+        f"ORDER BY transaction_id "
+        f"ON CONFLICT (transaction_id) {on_conflict} "
+        f"RETURNING (xmax = 0) AS inserted")).fetchall()
+
+    inserted = sum(1 for row in result if row.inserted)
+    updated = len(result) - inserted
+    return {"inserted": inserted, "updated": updated,
+            "skipped": len(chunk) - inserted - updated, "groups": groups}
+
+
+def upsert_chunk_partitioned(conn: Connection, chunk: pd.DataFrame,
+                             mode: str):
+    """ `upsert_chunk_pg` for a partitioned `data_table`, which has no
+    unique constraint on `transaction_id` alone to put ON CONFLICT on (and no
+    system columns to read back from RETURNING). The ids are claimed in
+    `data_key` instead, and only the rows whose id was new are inserted;
+    `upsert` then updates the stored rows that differ, which moves them to
+    another partition if their `transaction_time` changed.
+    """
+    table = models.Data.__tablename__
+    _stage(conn, chunk)
+
+    columns = ', '.join(TABLE_COLUMNS)
+    inserted = conn.execute(text(
+        f"WITH new AS (INSERT INTO {models.DataKey.__tablename__} "
+        f"(transaction_id) SELECT DISTINCT transaction_id FROM {STAGING_TABLE} "
+        f"ON CONFLICT (transaction_id) DO NOTHING RETURNING transaction_id) "
+        f"INSERT INTO {table} ({columns}) "
+        f"SELECT DISTINCT ON (transaction_id) {columns} "
+        f"FROM {STAGING_TABLE} JOIN new USING (transaction_id) "
+        f"ORDER BY transaction_id")).rowcount
+
+    updated = 0
+    groups = set()
+    if mode == 'upsert':
+        groups = _changed_groups(conn)
+        # the rows inserted above equal their staged row, so only rows that
+        # were already stored get updated
+        updates = ', '.join(f"{c} = {STAGING_TABLE}.{c}"
+                            for c in TABLE_COLUMNS[1:])
+        updated = conn.execute(text(
+            f"UPDATE {table} AS stored SET {updates} FROM ("
+            f"SELECT DISTINCT ON (transaction_id) * FROM {STAGING_TABLE} "
+            f"ORDER BY transaction_id) AS {STAGING_TABLE} "
+            f"WHERE stored.transaction_id = {STAGING_TABLE}.transaction_id "
+            f"AND {_distinct_from_staged('stored')}")).rowcount
+
+    return {"inserted": inserted, "updated": updated,
+            "skipped": len(chunk) - inserted - updated, "groups": groups}
+
+
+class ChunkLoader:
+    """ Validates chunks and loads them into `data_table` over one connection,
+    keeping the counts `load_csv` reports.
+
+    In `append` mode any duplicate key aborts the whole load. The `upsert`
+    (update on conflict) and `ignore` (skip on conflict) modes are idempotent;
+    each batch runs in its own savepoint so a failing batch is reported and
+    the remaining ones are still loaded.
+    With `invalid='quarantine'` rows that fail validation are written to a
+    `validation.Quarantine` file and the rest is loaded; with `'abort'` they
+    raise `validation.InvalidRows`.
+    `progress` is called with the running row count after every chunk; an
+    exception raised from it aborts the load.
+    """
+
+    def __init__(self, conn: Connection, mode: str = 'append',
+                 progress: Optional[Callable[[int], None]] = None,
+                 invalid: str = 'quarantine'):
+        self.conn = conn
+        self.mode = mode
+        self.progress = progress
+        self.quarantine = validation.Quarantine() \
+            if invalid == 'quarantine' else None
+        self.batches = []
+        self.days = set()
+        self.groups = set()
+        self.read = 0
+        self.rows = 0
+        self.failed_rows = 0
+        self.chunks = 0
+        self.start = time.perf_counter()
+
+    def load(self, chunk: pd.DataFrame):
+        first_row = self.read + 1
+        self.read += len(chunk)
+        chunk = validation.check_chunk(chunk, first_row, self.quarantine)
+        if not len(chunk):
+            return
+        chunk = encode_dimensions(self.conn, chunk)
+        chunk_days = set(chunk['transaction_time'].dt.date.unique())
+        partitions.ensure_months(self.conn, chunk_days - self.days)
+        counts = {}
+        if self.mode == 'append':
+            copy_keys(self.conn, chunk)
+            copy_chunk(self.conn, chunk)
+        else:
+            savepoint = self.conn.begin_nested()
+            try:
+                counts = upsert_chunk_pg(self.conn, chunk, self.mode)
+                savepoint.commit()
+                self.groups.update(counts.pop("groups"))
+            except DBAPIError as e:
+                savepoint.rollback()
+                counts = {"error": str(e.orig)}
+            self.batches.append(
+                {"batch": self.chunks, "rows": len(chunk), **counts})
+        self.chunks += 1
+        if "error" in counts:
+            # nothing of a failed batch was written, it has no days to refresh
+            self.failed_rows += len(chunk)
+        else:
+            self.rows += len(chunk)
+            self.days.update(chunk_days)
+        if self.progress:
+            self.progress(self.rows)
+
+    def load_bytes(self, data: bytes, encoding: str = 'utf-8'):
+        self.load(parse_csv(data, encoding))
+
+    def stats(self):
+        """ Returns the written row count, the ingest rate, the set of days
+        touched, the rollup keys updated rows were moved away from, the
+        rejected rows and, for the idempotent modes, the per-batch counts
+        and the rows of the failed batches.
+        """
+        elapsed = time.perf_counter() - self.start
+        stats = {
+            "rows": self.rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(self.rows / elapsed) if elapsed
+            else self.rows,
+            "days": self.days,
+            "groups": self.groups,
+        }
+        if self.quarantine is not None:
+            stats["rejected"] = self.quarantine.rows
+            stats["quarantine_file"] = self.quarantine.path
+        if self.mode != 'append':
+            for key in ("inserted", "updated", "skipped"):
+                stats[key] = sum(batch.get(key, 0) for batch in self.batches)
+            stats["failed_batches"] = sum(
+                1 for batch in self.batches if "error" in batch)
+            stats["failed_rows"] = self.failed_rows
+            stats["batches"] = self.batches
+        return stats
+
+
+def load_csv(conn: Connection, path: str, chunk_size: int = CHUNK_SIZE,
+             mode: str = 'append',
+             progress: Optional[Callable[[int], None]] = None,
+             invalid: str = 'quarantine'):
+    """ Streams the csv into `data_table` chunk by chunk, so memory use is
+    bounded by `chunk_size` rather than by the file size. See `ChunkLoader`
+    for the modes and the returned stats.
+    """
+    loader = ChunkLoader(conn, mode, progress, invalid)
+    for chunk in read_chunks(path, chunk_size):
+        loader.load(chunk)
+    return loader.stats()
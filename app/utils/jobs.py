@@ -0,0 +1,316 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+
+from app.utils import config, crud, export, models, schemas
+from app.utils.concurrency import offload
+from app.utils.database import SessionLocal, read_session
+
+logger = logging.getLogger("app.jobs")
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+PROGRESS_INTERVAL = 1.0  # seconds between progress writes
+HEARTBEAT_INTERVAL = 5.0  # seconds
+MAX_ATTEMPTS = 3  # runs of a job whose worker died before it is failed
+# pg_advisory_xact_lock key serializing claims across all workers
+CLAIM_LOCK_ID = 72610541
+
+# Every worker runs JOB_WORKERS runner threads of its own, separate from the
+# request executor, so a long load never holds a thread interactive queries
+# are waiting for. They take queued jobs from the job table, and `_claim`
+# keeps at most JOB_WORKERS jobs running across all workers.
+_runners: List[threading.Thread] = []
+_stop = threading.Event()
+_wake = threading.Event()
+# jobs running in this worker, their heartbeat is kept up by `_beat`
+_running = set()
+_running_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _Progress:
+    """ Progress callback for the ingest and export loops. Writes the row
+    count at most every `PROGRESS_INTERVAL` seconds, through its own session
+    so it is visible while the job's transaction is still open, and raises
+    `JobCancelled` once a cancel has been requested.
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.start = time.perf_counter()
+        self.last_write = 0.0
+
+    def __call__(self, rows: int):
+        now = time.perf_counter()
+        if now - self.last_write < PROGRESS_INTERVAL:
+            return
+        self.last_write = now
+        with SessionLocal() as db:
+            job = db.get(models.Job, self.job_id)
+            job.rows = rows
+            job.seconds = round(now - self.start, 3)
+            cancelled = job.cancel_requested
+            db.commit()
+        if cancelled:
+            raise JobCancelled()
+
+
+def _run_upload(db: Session, job: models.Job, progress: _Progress):
+    result = crud.upload_data.__wrapped__(
+        db, mode=job.params["mode"], progress=progress,
+        invalid=job.params.get("invalid", 'quarantine'))
+    if result == crud.DUPLICATE_UPLOAD:
+        raise ValueError(result)
+    return result
+
+
+def _run_export(db: Session, job: models.Job, progress: _Progress):
+    with read_session() as read_db:
+        return _write_export(read_db, job, progress)
+
+
+def _write_export(db: Session, job: models.Job, progress: _Progress):
+    params = job.params
+    query = crud.export_query(db, schemas.DataFilter(**params["filters"]),
+                              params["fields"])
+    os.makedirs(config.JOB_DIR, exist_ok=True)
+    path = result_path(job)
+    rows = {"count": 0}
+
+    def count(total):
+        rows["count"] = total
+        progress(total)
+
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, 'wb') as file:
+            for chunk in export.stream_rows(query, params["fields"],
+                                            params["format"], progress=count):
+                file.write(chunk.encode() if isinstance(chunk, str)
+                           else chunk)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+    return {"rows": rows["count"], "bytes": os.path.getsize(path)}
+
+
+RUNNERS = {'upload': _run_upload, 'export': _run_export}
+
+
+def result_path(job: models.Job) -> str:
+    return os.path.join(config.JOB_DIR,
+                        f"{job.job_id}.{job.params['format']}")
+
+
+def _finish(job_id: str, status: str, **values):
+    with SessionLocal() as db:
+        job = db.get(models.Job, job_id)
+        job.status = status
+        job.finished_at = datetime.utcnow()
+        for key, value in values.items():
+            setattr(job, key, value)
+        db.commit()
+
+
+def _requeue_stale(db: Session):
+    """ Puts the running jobs whose worker stopped sending heartbeats back in
+    the queue. Their work was rolled back (uploads) or never moved into place
+    (exports), so they can start over; after `MAX_ATTEMPTS` runs they fail.
+    """
+    now = datetime.utcnow()
+    jobs = db.query(models.Job).filter(
+        models.Job.status == 'running',
+        or_(models.Job.heartbeat_at.is_(None),
+            models.Job.heartbeat_at <
+            now - timedelta(seconds=config.JOB_STALE_SECONDS)))
+    jobs.filter(models.Job.cancel_requested).update(
+        {models.Job.status: 'cancelled', models.Job.finished_at: now},
+        synchronize_session=False)
+    jobs.filter(models.Job.attempts >= MAX_ATTEMPTS).update(
+        {models.Job.status: 'failed', models.Job.finished_at: now,
+         models.Job.error: "The worker running the job stopped"},
+        synchronize_session=False)
+    jobs.update({models.Job.status: 'queued', models.Job.started_at: None,
+                 models.Job.rows: 0, models.Job.seconds: 0.0},
+                synchronize_session=False)
+
+
+def _claim() -> Optional[str]:
+    """ Marks the oldest queued job as running and returns its id, unless
+    `JOB_WORKERS` jobs are running already. Claims are serialized by an
+    advisory lock, so the running count cannot be overtaken between the
+    check and the update.
+    """
+    with SessionLocal() as db:
+        if db.get_bind().dialect.name == 'postgresql':
+            db.execute(select(func.pg_advisory_xact_lock(CLAIM_LOCK_ID)))
+        _requeue_stale(db)
+        running = db.query(models.Job).filter(
+            models.Job.status == 'running').count()
+        job = None
+        if running < config.JOB_WORKERS:
+            # a row locked by a concurrent cancel is left for the next round
+            job = db.query(models.Job) \
+                .filter(models.Job.status == 'queued') \
+                .order_by(models.Job.created_at).limit(1) \
+                .with_for_update(skip_locked=True).first()
+        if job is not None:
+            now = datetime.utcnow()
+            job.status = 'running'
+            job.started_at = job.heartbeat_at = now
+            job.attempts += 1
+        db.commit()
+        return job.job_id if job is not None else None
+
+
+def _run(job_id: str):
+    with _running_lock:
+        _running.add(job_id)
+    try:
+        _execute(job_id)
+    finally:
+        with _running_lock:
+            _running.discard(job_id)
+
+
+def _execute(job_id: str):
+    with SessionLocal() as db:
+        job = db.get(models.Job, job_id)
+        progress = _Progress(job_id)
+        try:
+            result = RUNNERS[job.kind](db, job, progress)
+        except JobCancelled:
+            # the load runs in one transaction, so nothing of it is kept
+            db.rollback()
+            _finish(job_id, 'cancelled')
+            return
+        except Exception as e:
+            db.rollback()
+            logger.exception("job %s failed", job_id)
+            _finish(job_id, 'failed', error=str(e))
+            return
+        rows = result.get("rows", 0)
+        seconds = round(time.perf_counter() - progress.start, 3)
+        _finish(job_id, 'succeeded', rows=rows, seconds=seconds,
+                result=result)
+
+
+def _work():
+    while not _stop.is_set():
+        try:
+            job_id = _claim()
+        except Exception:
+            logger.exception("could not claim a job")
+            job_id = None
+        if job_id is None:
+            _wake.wait(config.JOB_POLL_INTERVAL)
+            _wake.clear()
+            continue
+        _run(job_id)
+
+
+def _beat():
+    while not _stop.wait(HEARTBEAT_INTERVAL):
+        with _running_lock:
+            job_ids = list(_running)
+        if not job_ids:
+            continue
+        try:
+            with SessionLocal() as db:
+                db.query(models.Job).filter(
+                    models.Job.job_id.in_(job_ids),
+                    models.Job.status == 'running').update(
+                    {models.Job.heartbeat_at: datetime.utcnow()},
+                    synchronize_session=False)
+                db.commit()
+        except Exception:
+            logger.exception("could not record the job heartbeat")
+
+
+def start():
+    """ Starts this worker's runner and heartbeat threads.
+    """
+    if _runners:
+        return
+    for number in range(config.JOB_WORKERS):
+        _runners.append(threading.Thread(
+            target=_work, name=f"job-{number}", daemon=True))
+    _runners.append(threading.Thread(
+        target=_beat, name="job-heartbeat", daemon=True))
+    for thread in _runners:
+        thread.start()
+
+
+@offload
+def submit(db: Session, kind: str, params: dict, owner: str):
+    """ Stores a queued job, for the first runner with room to take it.
+    """
+    job = models.Job(kind=kind, params=params, owner=owner)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    _wake.set()
+    return job
+
+
+@offload
+def get_job(db: Session, job_id: str) -> Optional[models.Job]:
+    return db.get(models.Job, job_id)
+
+
+@offload
+def list_jobs(db: Session, status: Optional[str] = None,
+              limit: int = 100) -> List[models.Job]:
+    query = db.query(models.Job)
+    if status:
+        query = query.filter(models.Job.status == status)
+    return query.order_by(models.Job.created_at.desc()).limit(limit).all()
+
+
+@offload
+def cancel(db: Session, job_id: str) -> Optional[models.Job]:
+    """ Queued jobs are cancelled right away; running ones stop at their next
+    progress check and roll back.
+    """
+    # conditional updates, a worker may claim the job at the same time
+    jobs = db.query(models.Job).filter(models.Job.job_id == job_id)
+    jobs.filter(models.Job.status == 'queued').update(
+        {models.Job.status: 'cancelled',
+         models.Job.finished_at: datetime.utcnow()},
+        synchronize_session=False)
+    jobs.filter(models.Job.status == 'running').update(
+        {models.Job.cancel_requested: True}, synchronize_session=False)
+    db.commit()
+    return db.get(models.Job, job_id)
+
+
+def shutdown():
+    """ Stops taking jobs. A job still running is abandoned with the
+    process, and requeued once its heartbeat is `JOB_STALE_SECONDS` old.
+    """
+    _stop.set()
+    _wake.set()
@@ -0,0 +1,82 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, \
+    Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route",
+    ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests currently being served",
+    multiprocess_mode="livesum")
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "SQL statement duration", ["statement"])
+QUERY_ROWS = Histogram(
+    "db_query_rows", "Rows returned or affected by a SQL statement",
+    ["statement"], buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+ROWS_RETURNED = Histogram(
+    "data_rows_returned", "Rows returned by the data endpoints", ["endpoint"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+INGEST_ROWS = Counter("ingest_rows_total", "Rows loaded by /data/upload/")
+INGEST_SECONDS = Counter(
+    "ingest_seconds_total", "Time spent loading rows in /data/upload/")
+CACHE_HITS = Counter(
+    "cache_hits_total", "Lookups answered by an in-process cache", ["cache"])
+CACHE_MISSES = Counter(
+    "cache_misses_total", "Lookups an in-process cache could not answer",
+    ["cache"])
+
+
+def watch_cache(name: str, cache):
+    """ Reports the hits and misses of a `TTLCache` under `name`.
+    """
+    cache.on_hit = CACHE_HITS.labels(name).inc
+    cache.on_miss = CACHE_MISSES.labels(name).inc
+
+
+def instrument_engine(engine: Engine):
+    """ Times every statement run through the engine.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() \
+            if statement.strip() else "OTHER"
+        QUERY_DURATION.labels(kind).observe(elapsed)
+        if cursor.rowcount >= 0:
+            QUERY_ROWS.labels(kind).observe(cursor.rowcount)
+
+
+def render():
+    """ Returns the exposition body and its content type. Under gunicorn with
+    `PROMETHEUS_MULTIPROC_DIR` set, the samples of all workers are merged.
+    """
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
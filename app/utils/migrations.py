@@ -0,0 +1,221 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+from app.utils import models, partitions, rollups
+
+logger = logging.getLogger("app.migrations")
+
+# pg_advisory_lock key, the same in every worker
+MIGRATION_LOCK_ID = 72610540
+
+
+@contextmanager
+def migration_lock(engine: Engine):
+    """ Holds a PostgreSQL advisory lock, so workers starting together run
+    the migrations one after the other. The lock is taken outside any
+    transaction, which `CREATE INDEX CONCURRENTLY` would otherwise wait for.
+    """
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"),
+                     {"id": MIGRATION_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"),
+                         {"id": MIGRATION_LOCK_ID})
+
+
+def migrate(engine: Engine):
+    """ Creates the missing tables and runs every `ensure_*` step. Safe to
+    run from many workers at once, and again on every start.
+    """
+    with migration_lock(engine):
+        models.Base.metadata.create_all(bind=engine)
+        ensure_dimensions(engine)
+        ensure_partitions(engine)
+        created = ensure_indexes(engine)
+        if created:
+            logger.info("created indexes %s", ", ".join(created))
+        ensure_rollups(engine)
+        ensure_data_version(engine)
+        ensure_job_columns(engine)
+
+
+def index_names(conn, table: str):
+    if conn.dialect.name == 'postgresql':
+        # unlike the inspector, pg_index also covers partitioned tables;
+        # an interrupted concurrent build leaves an invalid index behind
+        return set(conn.execute(text(
+            "SELECT index.relname FROM pg_index "
+            "JOIN pg_class index ON index.oid = pg_index.indexrelid "
+            "JOIN pg_class tbl ON tbl.oid = pg_index.indrelid "
+            "WHERE tbl.relname = :table AND pg_index.indisvalid"),
+            {"table": table}).scalars())
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+def _create_index_pg(conn, index, concurrently: bool):
+    option = "CONCURRENTLY " if concurrently else ""
+    conn.execute(text(f"DROP INDEX {option}IF EXISTS {index.name}"))
+    ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(re.sub(r"^CREATE (UNIQUE )?INDEX ",
+                                rf"CREATE \1INDEX {option}IF NOT EXISTS ",
+                                ddl))
+
+
+def ensure_indexes(engine: Engine):
+    """ Creates the indexes declared on the models that are missing from
+    tables built by an earlier version (`create_all` skips existing tables).
+    On PostgreSQL they are built with `CREATE INDEX CONCURRENTLY`, which
+    does not block writes; partitioned tables do not support it and are
+    indexed with a plain `CREATE INDEX`.
+    Returns the names of the indexes that were created.
+    """
+    created = []
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            for table in models.Base.metadata.sorted_tables:
+                existing = index_names(conn, table.name)
+                for index in table.indexes:
+                    if index.name not in existing:
+                        index.create(bind=conn)
+                        created.append(index.name)
+        return created
+
+    # concurrent builds cannot run inside a transaction
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        partitioned = set(conn.execute(text(
+            "SELECT relname FROM pg_class WHERE relkind = 'p'")).scalars())
+        for table in models.Base.metadata.sorted_tables:
+            existing = index_names(conn, table.name)
+            for index in table.indexes:
+                if index.name not in existing:
+                    _create_index_pg(conn, index,
+                                     table.name not in partitioned)
+                    created.append(index.name)
+        if created:
+            # refresh planner statistics so the new indexes get used
+            for table in models.Base.metadata.sorted_tables:
+                conn.exec_driver_sql(f"ANALYZE {table.name}")
+    return created
+
+
+def ensure_dimensions(engine: Engine):
+    """ Moves a `data_table` created before the city and product dimension
+    tables, which stored both names on every row, to their integer ids.
+    `data_rollup` is rebuilt by `ensure_rollups` afterwards.
+    """
+    with engine.begin() as conn:
+        columns = {column["name"]
+                   for column in inspect(conn).get_columns("data_table")}
+        if "delivered_to_city" not in columns:
+            return
+        moves = [("city", "city_id", "delivered_to_city"),
+                 ("product", "product_id", "product_name")]
+        for table, key, name in moves:
+            conn.execute(text(
+                f"INSERT INTO {table} (name) SELECT DISTINCT d.{name} "
+                f"FROM data_table d WHERE d.{name} IS NOT NULL AND NOT EXISTS "
+                f"(SELECT 1 FROM {table} t WHERE t.name = d.{name})"))
+            conn.execute(text(
+                f"ALTER TABLE data_table ADD COLUMN {key} INTEGER"))
+        conn.execute(text(
+            "UPDATE data_table SET "
+            "city_id = (SELECT city_id FROM city "
+            "WHERE city.name = data_table.delivered_to_city), "
+            "product_id = (SELECT product_id FROM product "
+            "WHERE product.name = data_table.product_name)"))
+        for _, _, name in moves:
+            # drops the indexes on the names along with them
+            conn.execute(text(f"ALTER TABLE data_table DROP COLUMN {name}"))
+        models.DataRollup.__table__.drop(conn)
+        models.DataRollup.__table__.create(conn)
+
+
+def ensure_partitions(engine: Engine):
+    """ Checks that `data_table` matches `DATA_PARTITIONED`, adds its
+    default partition and fills `data_key` for tables partitioned before it
+    existed.
+    """
+    with engine.begin() as conn:
+        if not partitions.enabled(conn):
+            return
+        relkind = conn.execute(text(
+            "SELECT relkind FROM pg_class WHERE relname = :table"),
+            {"table": partitions.TABLE}).scalar()
+        if relkind != 'p':
+            raise RuntimeError(
+                "DATA_PARTITIONED is set but data_table already exists as "
+                "a regular table; move its rows into a partitioned copy first")
+        partitions.ensure_default(conn)
+        keys = models.DataKey.__table__
+        if conn.execute(select(keys.c.transaction_id).limit(1)).first() is None:
+            # ids stored twice before then stay duplicated, only new ones
+            # are rejected
+            conn.execute(text(
+                f"INSERT INTO {keys.name} (transaction_id) "
+                f"SELECT DISTINCT transaction_id FROM {partitions.TABLE} "
+                f"WHERE transaction_id IS NOT NULL"))
+
+
+def ensure_data_version(engine: Engine):
+    with engine.begin() as conn:
+        if conn.execute(select(models.DataVersion.version_id)).first() is None:
+            conn.execute(models.DataVersion.__table__.insert().values(
+                version_id=1, version=0))
+
+
+def ensure_job_columns(engine: Engine):
+    """ Adds the columns the job queue needs to a `job` table created
+    before them.
+    """
+    with engine.begin() as conn:
+        columns = {column["name"]
+                   for column in inspect(conn).get_columns("job")}
+        if "attempts" not in columns:
+            conn.execute(text("ALTER TABLE job ADD COLUMN attempts "
+                              "INTEGER NOT NULL DEFAULT 0"))
+        if "heartbeat_at" not in columns:
+            conn.execute(text("ALTER TABLE job ADD COLUMN heartbeat_at "
+                              "TIMESTAMP"))
+
+
+def ensure_rollups(engine: Engine):
+    """ Fills `data_rollup` the first time it is created next to existing data.
+    """
+    with engine.begin() as conn:
+        if conn.execute(select(models.DataRollup.rollup_id).limit(1)).first():
+            return
+        if conn.execute(select(models.Data.transaction_id).limit(1)).first():
+            rollups.refresh_all(conn)
+
+
+if __name__ == "__main__":
+    from app.utils.database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    migrate(engine)
@@ -12,10 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, Float, Boolean, Index, JSON, Text, func
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import relationship
 from app.utils.database import Base
+from app.utils import config
 import uuid
+from datetime import datetime
+
+
+class City(Base):
+    """ Dimension table of the city names referenced by `Data.city_id`.
+    """
+    __tablename__ = "city"
+
+    city_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+    __table_args__ = (
+        # filters compare lower-cased names
+        Index("ix_city_name_lower", func.lower(name)),
+    )
+
+
+class Product(Base):
+    """ Dimension table of the product names referenced by `Data.product_id`.
+    """
+    __tablename__ = "product"
+
+    product_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
 
 
 class Data(Base):
@@ -23,12 +50,103 @@ class Data(Base):
 
     transaction_id = Column(
         UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
-    transaction_time = Column(DateTime)
-    product_name = Column(String)
+    # a partitioned table's primary key has to contain the partition key
+    transaction_time = Column(DateTime, primary_key=config.DATA_PARTITIONED)
+    # no foreign keys, their per-row checks would slow down COPY; the ids
+    # are only ever assigned through `app.utils.dimensions`
+    product_id = Column(Integer)
     quantity = Column(Integer)
     unit_price = Column(Float)
     total_price = Column(Float)
-    delivered_to_city = Column(String)
+    city_id = Column(Integer)
+
+    # the names are joined in whenever rows are loaded as objects
+    product = relationship(
+        Product, primaryjoin="foreign(Data.product_id) == Product.product_id",
+        lazy="joined", viewonly=True)
+    city = relationship(
+        City, primaryjoin="foreign(Data.city_id) == City.city_id",
+        lazy="joined", viewonly=True)
+    product_name = association_proxy("product", "name")
+    delivered_to_city = association_proxy("city", "name")
+
+    __table_args__ = (
+        # keyset pagination order for /data/all, also serves date ranges
+        Index("ix_data_table_time_id", "transaction_time", "transaction_id"),
+        Index("ix_data_table_city_id", city_id),
+        Index("ix_data_table_total_price", total_price),
+        Index("ix_data_table_quantity", quantity),
+        Index("ix_data_table_product_id", product_id),
+        {"postgresql_partition_by": "RANGE (transaction_time)"}
+        if config.DATA_PARTITIONED else {},
+    )
+
+
+class DataKey(Base):
+    """ Every stored `transaction_id`, kept by `app.utils.ingest` and `crud`
+    only when `data_table` is partitioned: its primary key then also holds
+    `transaction_time`, so this table is what keeps the ids unique.
+    """
+    __tablename__ = "data_key"
+
+    transaction_id = Column(UUID(as_uuid=True), primary_key=True)
+
+
+class DataRollup(Base):
+    """ Per day, city and product totals of `data_table`, kept up to date by
+    `app.utils.rollups` and read by `/data/stats`.
+    """
+    __tablename__ = "data_rollup"
+
+    rollup_id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    city_id = Column(Integer)
+    product_id = Column(Integer)
+    row_count = Column(Integer, nullable=False)
+    quantity_sum = Column(Integer, nullable=False)
+    total_price_sum = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_data_rollup_key", "day", "city_id", "product_id"),
+    )
+
+
+class DataVersion(Base):
+    """ Single row counter bumped by every write to `data_table`, the
+    response cache keys its entries on it.
+    """
+    __tablename__ = "data_version"
+
+    version_id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+class Job(Base):
+    """ A background ingest or export run, see `app.utils.jobs`.
+    """
+    __tablename__ = "job"
+
+    job_id = Column(String(32), primary_key=True,
+                    default=lambda: uuid.uuid4().hex)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued", index=True)
+    params = Column(JSON, nullable=False, default=dict)
+    owner = Column(String)
+    rows = Column(BigInteger, nullable=False, default=0)
+    seconds = Column(Float, nullable=False, default=0.0)
+    result = Column(JSON)
+    error = Column(Text)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    # refreshed while the job runs, a stale one means its worker is gone
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    @property
+    def rows_per_sec(self):
+        return round(self.rows / self.seconds) if self.seconds else None
 
 
 class AdminUser(Base):
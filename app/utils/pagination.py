@@ -0,0 +1,71 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+from app.utils import models
+
+MAX_PAGE_SIZE = 10000
+# Rows beyond this offset should be fetched using `cursor` instead, since
+# OFFSET still has to walk over every skipped row.
+MAX_OFFSET_ROWS = 100000
+
+
+def encode_cursor(row) -> str:
+    """ Builds an opaque cursor pointing just after the given row.
+    """
+    payload = json.dumps({
+        "t": row.transaction_time.isoformat() if row.transaction_time else None,
+        "id": str(row.transaction_id),
+    }, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], UUID]:
+    """ Reverses `encode_cursor`. Raises ValueError for malformed cursors.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        transaction_time = datetime.fromisoformat(
+            payload["t"]) if payload["t"] else None
+        return transaction_time, UUID(payload["id"])
+    except (TypeError, KeyError, ValueError, json.JSONDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def keyset_order(query: Query) -> Query:
+    return query.order_by(models.Data.transaction_time,
+                          models.Data.transaction_id)
+
+
+def keyset_after(query: Query, cursor: str) -> Query:
+    """ Restricts an ordered query to rows strictly after the cursor. This is
+    served by the (transaction_time, transaction_id) index so the cost does not
+    depend on how deep the page is.
+    """
+    transaction_time, transaction_id = decode_cursor(cursor)
+    if transaction_time is None:
+        return query.filter(models.Data.transaction_time.is_(None),
+                            models.Data.transaction_id > transaction_id)
+    return query.filter(
+        tuple_(models.Data.transaction_time, models.Data.transaction_id) >
+        tuple_(transaction_time, transaction_id))
@@ -0,0 +1,109 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from datetime import date
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.utils import config, models
+
+TABLE = models.Data.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_y(\d{{4}})m(\d{{2}})$")
+
+
+def enabled(conn: Connection) -> bool:
+    return config.DATA_PARTITIONED and conn.dialect.name == 'postgresql'
+
+
+def _month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def _next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{TABLE}_y{month.year:04d}m{month.month:02d}"
+
+
+def list_partitions(conn: Connection):
+    """ Maps the start of each monthly partition to its name.
+    """
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table"), {"table": TABLE})
+    partitions = {}
+    for (name,) in rows:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def ensure_default(conn: Connection):
+    """ Catches rows whose month has no partition yet, so inserts never fail.
+    """
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+        f"PARTITION OF {TABLE} DEFAULT"))
+
+
+def ensure_months(conn: Connection, days: Iterable[date]):
+    """ Creates the monthly partitions covering `days` that do not exist yet.
+    Existing ones are looked up first, since creating a partition locks the
+    parent table.
+    """
+    if not enabled(conn):
+        return []
+    months = {_month_start(day) for day in days if day is not None}
+    missing = sorted(months - set(list_partitions(conn)))
+    for month in missing:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF {TABLE} FOR VALUES "
+            f"FROM ('{month.isoformat()}') TO "
+            f"('{_next_month(month).isoformat()}')"))
+    return [partition_name(month) for month in missing]
+
+
+def drop_before(conn: Connection, cutoff: date, detach: bool = False):
+    """ Drops (or only detaches) every monthly partition that ends on or
+    before `cutoff`. Each one is a catalog operation, apart from removing its
+    ids from `data_key`.
+    Returns the names of the partitions removed.
+    Raises ValueError when `data_table` is not partitioned.
+    """
+    if not enabled(conn):
+        raise ValueError("data_table is not partitioned")
+    removed = []
+    for month, name in sorted(list_partitions(conn).items()):
+        if _next_month(month) > cutoff:
+            break
+        # the ids of the removed rows may be loaded again
+        conn.execute(text(
+            f"DELETE FROM {models.DataKey.__tablename__} WHERE transaction_id "
+            f"IN (SELECT transaction_id FROM {name})"))
+        if detach:
+            conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+        else:
+            conn.execute(text(f"DROP TABLE {name}"))
+        removed.append(name)
+    return removed
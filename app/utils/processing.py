@@ -12,56 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from app.utils import models
-import csv
-import os
+import hashlib
+import time
 
 from typing import Optional
-from dotenv import load_dotenv
-from app.utils.schemas import AdminUserInDB
-from app.utils import crud
+from app.utils.schemas import AdminUserInDB, TokenData
+from app.utils import config, metrics
+from app.utils.cache import TTLCache
 from datetime import datetime, timedelta
 
 
 from sqlalchemy.orm import Session
-from jose import jwt
+from jose import JWTError, jwt
 
 from passlib.context import CryptContext
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-load_dotenv()
-SECRET_KEY = str(os.getenv("SECRET_KEY"))
-ALGORITHM = "HS256"
+# bcrypt cost factor for new hashes; existing hashes keep verifying with
+# their own cost and get flagged by `needs_update` once it changes
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=config.BCRYPT_ROUNDS)
 
-
-def sql_query_to_csv(query_output):
-    """ Converts output from a SQLAlchemy query to a .csv file.
-    """
-    with open('app/data/filter_results.csv', 'w') as csvfile:
-        writer = csv.DictWriter(
-            csvfile, fieldnames=['transaction_id', 'transaction_time', 'product_name',
-                                 'quantity', 'unit_price', 'total_price', 'delivered_to_city'])
-        writer.writeheader()
-        for row in query_output:
-            writer.writerow({
-                'transaction_id': str(row.transaction_id),
-                'transaction_time':  str(row.transaction_time),
-                'product_name':  str(row.product_name),
-                'quantity': int(row.quantity),
-                'unit_price': float(row.unit_price),
-                'total_price': int(row.quantity)*float(row.unit_price),
-                'delivered_to_city': str(row.delivered_to_city)
-            })
-
-
-def get_users(db_data):
-    data = {}
-    for item in db_data:
-        data.update({item.__dict__["username"]: {
-            "username": item.__dict__["username"],
-            "password":  item.__dict__["password"],
-        }})
-
-    return data
+# Verified tokens by digest. Each entry expires together with its token.
+token_cache = TTLCache(maxsize=config.TOKEN_CACHE_SIZE,
+                       ttl=config.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+metrics.watch_cache("token", token_cache)
 
 
 def verify_password(plain_password, password):
@@ -72,14 +46,7 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return AdminUserInDB(**user_dict)
-
-
-def authenticate_user(user_dict, username: str, password: str):
-    user = get_user(user_dict, username)
+def authenticate_user(user: Optional[AdminUserInDB], password: str):
     if not user:
         return False
     if not verify_password(password, user.password):
@@ -94,10 +61,34 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(
+        to_encode, config.SECRET_KEY, algorithm=config.ALGORITHM)
     return encoded_jwt
 
 
+def decode_access_token(access_token: str) -> TokenData:
+    """ Verifies the token and returns its claims. Tokens seen before are
+    served from `token_cache` without checking the signature again.
+    Raises JWTError for invalid or expired tokens.
+    """
+    key = hashlib.sha256(access_token.encode()).digest()
+    token_data = token_cache.get(key)
+    if token_data is not None:
+        return token_data
+
+    payload = jwt.decode(access_token, config.SECRET_KEY,
+                         algorithms=[config.ALGORITHM])
+    username: str = payload.get("sub")
+    if username is None:
+        raise JWTError("Token has no subject")
+    token_data = TokenData(username=username)
+
+    expires_in = payload.get("exp", 0) - time.time()
+    if expires_in > 0:
+        token_cache.set(key, token_data, ttl=expires_in)
+    return token_data
+
+
 def init_admin_user(db: Session):
     admin_exits = db.query(models.AdminUser).filter(
         models.AdminUser.username == "admin").first()
@@ -0,0 +1,205 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.utils import config
+
+PROFILE_HEADER = "X-Profile"
+
+slow_query_log = logging.getLogger("app.slow_query")
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar(
+    "request_profile", default=None)
+
+
+class RequestProfile:
+    """ Time spent per phase while serving one request, plus the cProfile
+    captures of its blocking calls when the request was sampled.
+    """
+
+    def __init__(self, timing: bool, sampled: bool):
+        self.timing = timing
+        self.sampled = sampled
+        self.phases = defaultdict(float)
+        self.profilers = []
+        self.in_auth = False
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def run(self, func):
+        """ Runs `func` in the calling thread, timing it (and profiling it
+        when sampled) as blocking work.
+        """
+        start = time.perf_counter()
+        try:
+            if not self.sampled:
+                return func()
+            profiler = cProfile.Profile()
+            with self._lock:
+                self.profilers.append(profiler)
+            return profiler.runcall(func)
+        finally:
+            if not self.in_auth:
+                self.add("blocking", time.perf_counter() - start)
+
+    def server_timing(self, total: float):
+        """ Builds a `Server-Timing` header value. `hydration` is the
+        blocking time not spent in SQL, mostly ORM loading; `serialization`
+        is whatever is left, mostly building the response.
+        """
+        db = self.phases["db"]
+        auth = self.phases["auth"]
+        blocking = self.phases["blocking"]
+        phases = {
+            "auth": auth,
+            "db": db,
+            "hydration": max(blocking - db, 0.0),
+            "serialization": max(total - auth - blocking, 0.0),
+            "total": total,
+        }
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}"
+                         for name, seconds in phases.items())
+
+    def dump(self, route: str):
+        """ Writes the merged cProfile stats to `PROFILE_DIR`.
+        """
+        if not self.profilers:
+            return None
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        name = route.strip("/").replace("/", "_").replace("{", "") \
+            .replace("}", "") or "root"
+        path = os.path.join(
+            config.PROFILE_DIR,
+            f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{name}.prof")
+        stats = pstats.Stats(*self.profilers)
+        stats.dump_stats(path)
+        return path
+
+
+def start(profile_header: Optional[str]) -> Optional[RequestProfile]:
+    """ Starts profiling the current request if it asked for timings or was
+    picked by `PROFILE_SAMPLE_RATE`.
+    """
+    timing = bool(profile_header)
+    sampled = random.random() < config.PROFILE_SAMPLE_RATE
+    if not (timing or sampled):
+        return None
+    profile = RequestProfile(timing, sampled)
+    _current.set(profile)
+    return profile
+
+
+def current() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+@contextmanager
+def auth_phase():
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    profile.in_auth = True
+    try:
+        yield
+    finally:
+        profile.in_auth = False
+        profile.add("auth", time.perf_counter() - start_time)
+
+
+def instrument_engine(engine: Engine):
+    """ Adds SQL time to the current request's profile and logs statements
+    slower than `SLOW_QUERY_MS` together with their plan.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.perf_counter() - conn.info["profile_start"].pop()
+        profile = _current.get()
+        if profile is not None:
+            profile.add("db", elapsed)
+        if config.SLOW_QUERY_MS and elapsed * 1000 >= config.SLOW_QUERY_MS:
+            log_slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+def _parameter_types(parameters):
+    # the values may be user data, only their types are logged
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def _explain(conn, statement, parameters):
+    # a raw cursor keeps EXPLAIN out of the engine events
+    dbapi_conn = conn.connection.connection
+    in_transaction = not getattr(dbapi_conn, "autocommit", False)
+    cursor = dbapi_conn.cursor()
+    try:
+        # a failed statement would abort the request's own transaction, a
+        # savepoint confines the failure to the EXPLAIN
+        if in_transaction:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute("EXPLAIN " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except conn.dialect.dbapi.Error as e:
+            if in_transaction:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            plan = f"EXPLAIN failed: {e}"
+        if in_transaction:
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    finally:
+        cursor.close()
+
+
+def log_slow_query(conn, statement, parameters, executemany, elapsed):
+    plan = None
+    if conn.dialect.name == 'postgresql' and not executemany \
+            and statement.lstrip().upper().startswith("SELECT"):
+        try:
+            plan = _explain(conn, statement, parameters)
+        except conn.dialect.dbapi.Error as e:
+            plan = f"EXPLAIN failed: {e}"
+    slow_query_log.warning("slow query (%.1f ms): %s\nparameter types: %r\n%s",
+                           elapsed * 1000, statement,
+                           _parameter_types(parameters) if not executemany
+                           else "<executemany>", plan or "")
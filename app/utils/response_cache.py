@@ -0,0 +1,197 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+from app.utils import config, metrics, models
+from app.utils.cache import TTLCache
+from app.utils.concurrency import run_blocking
+
+
+class Entry(NamedTuple):
+    body: bytes
+    media_type: str
+    headers: dict
+    etag: str
+
+
+local_cache = TTLCache(maxsize=config.RESPONSE_CACHE_SIZE,
+                       ttl=config.RESPONSE_CACHE_TTL)
+metrics.watch_cache("response", local_cache)
+# (version, checked_at) per engine, the replica may be behind the primary
+_versions = {}
+
+
+def enabled() -> bool:
+    return config.RESPONSE_CACHE_SIZE > 0
+
+
+def bump(db: Session):
+    """ Moves the data version forward; call it in the transaction of every
+    write to `data_table`, then `forget_version` once it has committed.
+    """
+    db.execute(update(models.DataVersion)
+               .where(models.DataVersion.version_id == 1)
+               .values(version=models.DataVersion.version + 1))
+
+
+def forget_version():
+    # this worker sees its own writes right away, others within
+    # RESPONSE_CACHE_VERSION_INTERVAL
+    _versions.clear()
+
+
+def _read_version(db: Session):
+    return db.query(models.DataVersion.version).filter(
+        models.DataVersion.version_id == 1).scalar()
+
+
+async def current_version(db: Session):
+    bind = db.get_bind()
+    version, checked_at = _versions.get(bind, (None, None))
+    now = time.monotonic()
+    if checked_at is None or \
+            now - checked_at >= config.RESPONSE_CACHE_VERSION_INTERVAL:
+        version = await run_blocking(_read_version, db)
+        _versions[bind] = (version, now)
+    return version
+
+
+def make_key(request: Request, version) -> str:
+    """ Same path and query parameters in any order give the same key.
+    """
+    params = sorted(request.query_params.multi_items())
+    raw = json.dumps([request.url.path, params, version])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _shared_path(key: str) -> str:
+    return os.path.join(config.RESPONSE_CACHE_DIR, key)
+
+
+def _shared_get(key: str) -> Optional[Entry]:
+    path = _shared_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > config.RESPONSE_CACHE_TTL:
+            return None
+        with open(path, 'rb') as file:
+            meta, body = file.read().split(b"\n", 1)
+    except (OSError, ValueError):
+        return None
+    meta = json.loads(meta)
+    return Entry(body, meta["media_type"], meta["headers"], meta["etag"])
+
+
+def _shared_set(key: str, entry: Entry):
+    os.makedirs(config.RESPONSE_CACHE_DIR, exist_ok=True)
+    meta = json.dumps({"media_type": entry.media_type,
+                       "headers": entry.headers, "etag": entry.etag})
+    tmp = f"{_shared_path(key)}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as file:
+        file.write(meta.encode() + b"\n" + entry.body)
+    os.replace(tmp, _shared_path(key))  # readers never see partial files
+    if random.random() < 0.01:
+        _shared_prune()
+
+
+def _shared_prune():
+    cutoff = time.time() - config.RESPONSE_CACHE_TTL
+    for name in os.listdir(config.RESPONSE_CACHE_DIR):
+        path = _shared_path(name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _to_entry(result) -> Entry:
+    if isinstance(result, Response):
+        body = result.body
+        media_type = result.media_type
+        headers = {name: value for name, value in result.headers.items()
+                   if name not in ("content-length", "content-type")}
+    else:
+        body = orjson.dumps(jsonable_encoder(result))
+        media_type = "application/json"
+        headers = {}
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return Entry(body, media_type, headers, etag)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """ Weak comparison of `etag` against an If-None-Match list, as GET and
+    HEAD requests use it: `*` or an equal tag, with any `W/` prefix ignored.
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _respond(request: Request, entry: Entry) -> Response:
+    headers = {**entry.headers, "ETag": entry.etag,
+               "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match", ""), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type,
+                    headers=headers)
+
+
+async def cached(request: Request, db: Session,
+                 build: Callable[[], Awaitable]):
+    """ Serves the response for `request` from the cache, calling `build` on
+    a miss. Entries are keyed by the data version, so any write makes them
+    unreachable. Streaming responses pass through uncached.
+    """
+    if not enabled():
+        return await build()
+
+    key = make_key(request, await current_version(db))
+    entry = None
+    if "no-cache" not in request.headers.get("cache-control", ""):
+        entry = local_cache.get(key)
+        if entry is None and config.RESPONSE_CACHE_DIR:
+            entry = await run_blocking(_shared_get, key)
+            if entry is not None:
+                local_cache.set(key, entry)
+
+    if entry is None:
+        result = await build()
+        if isinstance(result, StreamingResponse) or (
+                isinstance(result, Response) and result.status_code != 200):
+            return result
+        entry = _to_entry(result)
+        if len(entry.body) <= config.RESPONSE_CACHE_MAX_BODY:
+            local_cache.set(key, entry)
+            if config.RESPONSE_CACHE_DIR:
+                await run_blocking(_shared_set, key, entry)
+    return _respond(request, entry)
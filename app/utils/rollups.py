@@ -0,0 +1,109 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import Date, and_, cast, delete, func, insert, or_, select
+
+from app.utils import models
+
+data = models.Data.__table__
+rollup = models.DataRollup.__table__
+
+# beyond this many groups one OR-ed predicate per group stops paying off
+MAX_GROUP_KEYS = 100
+# pg_advisory_xact_lock key serializing rollup rebuilds across workers
+ROLLUP_LOCK_ID = 72610542
+
+ROLLUP_COLUMNS = ['day', 'city_id', 'product_id', 'row_count',
+                  'quantity_sum', 'total_price_sum']
+
+
+def _aggregate(*where):
+    day = cast(data.c.transaction_time, Date)
+    return select(
+        day,
+        data.c.city_id,
+        data.c.product_id,
+        func.count(),
+        func.coalesce(func.sum(data.c.quantity), 0),
+        func.coalesce(func.sum(data.c.total_price), 0.0),
+    ).where(data.c.transaction_time.isnot(None), *where) \
+        .group_by(day, data.c.city_id, data.c.product_id)
+
+
+def _rebuild(conn, rollup_where, data_where):
+    if conn.dialect.name == 'postgresql':
+        # held until commit: a concurrent rebuild of the same groups waits,
+        # then deletes the rows this one inserted instead of adding a copy
+        conn.execute(select(func.pg_advisory_xact_lock(ROLLUP_LOCK_ID)))
+    conn.execute(delete(rollup).where(*rollup_where))
+    conn.execute(insert(rollup).from_select(
+        ROLLUP_COLUMNS, _aggregate(*data_where)))
+
+
+def refresh_all(conn):
+    _rebuild(conn, [], [])
+
+
+def refresh_before(conn, day: date):
+    """ Recomputes every rollup row before `day`, used after retention.
+    """
+    _rebuild(conn, [rollup.c.day < day], [
+        data.c.transaction_time < datetime.combine(day, time.min)])
+
+
+def refresh_days(conn, days: Iterable[date]):
+    """ Recomputes every rollup row of the given days, used after ingest.
+    """
+    days = sorted(set(days))
+    if not days:
+        return
+    # the range lets the date filter use the transaction_time index
+    _rebuild(conn, [rollup.c.day.in_(days)], [
+        data.c.transaction_time >= datetime.combine(days[0], time.min),
+        data.c.transaction_time < datetime.combine(
+            days[-1] + timedelta(days=1), time.min),
+        cast(data.c.transaction_time, Date).in_(days),
+    ])
+
+
+def refresh_groups(conn, keys: Iterable[Tuple[Optional[datetime], int, int]]):
+    """ Recomputes the rollup rows of the given (transaction_time, city_id,
+    product_id) keys, used after updates and deletes.
+    Past `MAX_GROUP_KEYS` keys, whole days are recomputed instead.
+    """
+    keys = set(keys)
+    if len(keys) > MAX_GROUP_KEYS:
+        refresh_days(conn, (key[0].date() for key in keys
+                            if key[0] is not None))
+        return
+
+    rollup_where, data_where = [], []
+    for transaction_time, city, product in keys:
+        if transaction_time is None:
+            continue
+        day = transaction_time.date()
+        rollup_where.append(and_(rollup.c.day == day,
+                                 rollup.c.city_id == city,
+                                 rollup.c.product_id == product))
+        data_where.append(and_(
+            data.c.transaction_time >= datetime.combine(day, time.min),
+            data.c.transaction_time < datetime.combine(
+                day + timedelta(days=1), time.min),
+            data.c.city_id == city,
+            data.c.product_id == product))
+    if rollup_where:
+        _rebuild(conn, [or_(*rollup_where)], [or_(*data_where)])
@@ -14,7 +14,7 @@
 
 from uuid import uuid4, UUID
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -43,6 +43,14 @@ class DataUpdate(DataBase):
     delivered_to_city: str
 
 
+class DataBulkUpdate(DataUpdate):
+    transaction_id: UUID
+
+
+class DataBulkDelete(DataBase):
+    transaction_ids: List[UUID]
+
+
 class DataDelete(DataBase):
     transaction_id: UUID = Field(default_factory=uuid4)
 
@@ -60,6 +68,39 @@ class Data(DataBase):
         orm_mode = True
 
 
+class DataFilter(BaseModel):
+    """ Predicates for `/data/query`. Every field is optional and the ones
+    that are set are combined with AND.
+    """
+    city_name: Optional[str] = None
+    product_name: Optional[str] = None
+    date_start: Optional[datetime] = None
+    date_end: Optional[datetime] = None
+    min_total_price: Optional[float] = None
+    max_total_price: Optional[float] = None
+    min_quantity: Optional[int] = None
+    max_quantity: Optional[int] = None
+
+
+class Job(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    params: dict
+    rows: int
+    seconds: float
+    rows_per_sec: Optional[float] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
 class AdminUserBase(BaseModel):
     pass
 
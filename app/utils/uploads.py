@@ -0,0 +1,204 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import zlib
+from typing import AsyncIterator
+
+import zstandard
+from multipart.multipart import MultipartParser, parse_options_header
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+
+from app.utils import ingest
+from app.utils.concurrency import run_blocking
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def has_body(request: Request) -> bool:
+    return request.headers.get("content-length", "0") != "0" or \
+        "chunked" in request.headers.get("transfer-encoding", "")
+
+
+async def request_body(request: Request) -> AsyncIterator[bytes]:
+    """ Yields the uploaded file as it arrives: the raw body, or the first
+    file part of a `multipart/form-data` body.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        async for data in _multipart_file(request, content_type):
+            yield data
+        return
+    async for data in request.stream():
+        if data:
+            yield data
+
+
+async def _multipart_file(request: Request, content_type: str):
+    # python-multipart's push parser, fed one network chunk at a time;
+    # Starlette's form parsing would spool the whole file first
+    _, options = parse_options_header(content_type)
+    if b"boundary" not in options:
+        raise ValueError("Missing multipart boundary")
+
+    state = {"field": b"", "value": b"", "is_file": False, "in_file": False,
+             "seen_file": False}
+    out = []
+
+    def on_part_begin():
+        state["is_file"] = False
+
+    def on_header_field(data, start, end):
+        state["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        if state["field"].lower() == b"content-disposition" and \
+                b"filename=" in state["value"]:
+            state["is_file"] = True
+        state["field"] = state["value"] = b""
+
+    def on_headers_finished():
+        state["in_file"] = state["is_file"] and not state["seen_file"]
+
+    def on_part_data(data, start, end):
+        if state["in_file"]:
+            out.append(bytes(data[start:end]))
+
+    def on_part_end():
+        if state["in_file"]:
+            state["in_file"] = False
+            state["seen_file"] = True
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    async for data in request.stream():
+        parser.write(data)
+        if out:
+            yield b"".join(out)
+            out.clear()
+    parser.finalize()
+    if not state["seen_file"]:
+        raise ValueError("The multipart body has no file part")
+
+
+class _GzipDecoder:
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        out = self._decoder.decompress(data)
+        while self._decoder.eof and self._decoder.unused_data:
+            # `cat a.gz b.gz` is a valid gzip file
+            rest = self._decoder.unused_data
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self._decoder.decompress(rest)
+        return out
+
+
+async def decompress(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """ Inflates gzip or zstd input on the fly, recognized by its magic
+    bytes; anything else passes through unchanged.
+    """
+    head = b""
+    decoder = None
+    async for data in chunks:
+        if head is not None:
+            head += data
+            if len(head) < len(ZSTD_MAGIC):
+                continue
+            data, head = head, None
+            if data.startswith(GZIP_MAGIC):
+                decoder = _GzipDecoder()
+            elif data.startswith(ZSTD_MAGIC):
+                decoder = zstandard.ZstdDecompressor().decompressobj()
+        if decoder is None:
+            yield data
+            continue
+        try:
+            yield decoder.decompress(data)
+        except (zlib.error, zstandard.ZstdError) as e:
+            raise ValueError(f"Could not decompress the upload: {e}")
+    if head:
+        yield head
+
+
+async def line_blocks(chunks: AsyncIterator[bytes],
+                      rows: int) -> AsyncIterator[bytes]:
+    """ Regroups the byte stream into blocks of at least `rows` whole lines
+    (the last one may be shorter). Quoted fields must not contain newlines.
+    """
+    pieces, lines = [], 0
+    async for data in chunks:
+        pieces.append(data)
+        lines += data.count(b"\n")
+        if lines >= rows:
+            block, _, rest = b"".join(pieces).rpartition(b"\n")
+            yield block + b"\n"
+            pieces, lines = [rest], 0
+    tail = b"".join(pieces)
+    if tail.strip():
+        yield tail
+
+
+async def load_stream(db: Session, chunks: AsyncIterator[bytes],
+                      mode: str = 'append',
+                      chunk_size: int = ingest.CHUNK_SIZE,
+                      invalid: str = 'quarantine'):
+    """ Loads a csv body into `data_table` while it is still being received:
+    each block of `chunk_size` rows is parsed, validated and loaded on the
+    executor while the next one arrives, so at most two blocks are held in
+    memory. The caller commits or rolls back `db`.
+    """
+    header = None
+    loader = None
+    pending = None
+    try:
+        async for block in line_blocks(decompress(chunks), chunk_size):
+            if header is None:
+                header, _, block = block.partition(b"\n")
+                header += b"\n"
+                encoding = ingest.sniff_encoding(
+                    block[:ingest.ENCODING_SAMPLE_SIZE])
+                loader = ingest.ChunkLoader(
+                    await run_blocking(db.connection), mode,
+                    invalid=invalid)
+                if not block.strip():
+                    continue
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(
+                run_blocking(loader.load_bytes, header + block, encoding))
+        if pending is not None:
+            await pending
+    except BaseException:
+        # the connection is only safe to roll back once the load has stopped
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        raise
+    if loader is None:
+        raise ValueError("The upload is empty")
+    return loader.stats()
@@ -0,0 +1,229 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import uuid
+from datetime import datetime
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.utils import config
+
+DT_FORMAT = "%Y%m%d %H%M%S"
+UUID_PATTERN = r"(?i)[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}"
+MAX_REPORTED_ERRORS = 20
+
+_HEX = np.zeros(256, dtype=bool)
+_HEX[np.frombuffer(b"0123456789abcdefABCDEF", dtype=np.uint8)] = True
+_UUID_DASHES = [8, 13, 18, 23]
+_UUID_HEX = [i for i in range(36) if i not in _UUID_DASHES]
+_DIGIT = ord("0")
+_TIME_DIGITS = [i for i in range(15) if i != 8]
+
+
+class InvalidRows(ValueError):
+    """ Raised when a chunk has rows that do not match `schemas.DataCreate`.
+    `errors` lists the first few as `{"row": ..., "reason": ...}`.
+    """
+
+    def __init__(self, count: int, errors: list):
+        super().__init__(f"{count} rows do not match the data schema")
+        self.count = count
+        self.errors = errors
+
+
+def _fixed_width(values: pd.Series, width: int):
+    """ Returns the strings of exactly `width` ascii characters as an
+    (n, width) uint8 matrix, plus the mask of rows that had that shape.
+    """
+    text = values.fillna("")
+    try:
+        # one byte per character, the extra column tells longer ones apart
+        raw = text.to_numpy(dtype=f"S{width + 1}")
+    except UnicodeEncodeError:
+        # non-ascii characters never pass the checks, '?' stands in for them
+        raw = np.array([value.encode("ascii", "replace") for value in text],
+                       dtype=f"S{width + 1}")
+    matrix = raw.view(np.uint8).reshape(-1, width + 1)
+    # shorter strings are NUL padded
+    mask = (matrix[:, width - 1] != 0) & (matrix[:, width] == 0)
+    return matrix[:, :width], mask
+
+
+def valid_uuids(ids: pd.Series) -> np.ndarray:
+    """ Checks the canonical 36 character form on the byte matrix; anything
+    else (no dashes, braces, ...) falls back to a regex.
+    """
+    matrix, canonical = _fixed_width(ids, 36)
+    valid = canonical & (matrix[:, _UUID_DASHES] == ord("-")).all(axis=1) \
+        & _HEX[matrix[:, _UUID_HEX]].all(axis=1)
+    rest = ~canonical & ids.notna().to_numpy()
+    if rest.any():
+        valid[rest] = ids[rest].str.fullmatch(UUID_PATTERN).to_numpy(bool)
+    return valid
+
+
+def parse_times(values: pd.Series) -> pd.Series:
+    """ Parses `DT_FORMAT` ("20220131 235959") from the digit positions of a
+    byte matrix and assembles the datetime64 values arithmetically, which is
+    far faster than strptime. Rows of any other shape go through
+    `pd.to_datetime` with the explicit format. Invalid values become NaT.
+    """
+    matrix, fixed = _fixed_width(values, 15)
+    # bytes below "0" wrap around to large values
+    digits = matrix - np.uint8(_DIGIT)
+    fixed &= (matrix[:, 8] == ord(" ")) & \
+        (digits[:, _TIME_DIGITS] <= 9).all(axis=1)
+    digits = np.where(fixed[:, None], digits, 0).astype(np.int64)
+
+    def number(start, end):
+        return digits[:, start:end] @ 10 ** np.arange(end - start - 1, -1, -1)
+
+    year, month, day = number(0, 4), number(4, 6), number(6, 8)
+    hour, minute, second = number(9, 11), number(11, 13), number(13, 15)
+    # datetime64[ns] covers the years 1678 to 2261
+    fixed &= (year >= 1678) & (year <= 2261) & (month >= 1) & \
+        (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+    month = np.where(fixed, month, 1)
+    months = ((np.where(fixed, year, 1970) - 1970) * 12 + month - 1) \
+        .astype('datetime64[M]')
+    first_days = months.astype('datetime64[D]')
+    month_lengths = ((months + 1).astype('datetime64[D]') - first_days) \
+        .astype(np.int64)
+    fixed &= (day >= 1) & (day <= month_lengths)
+
+    offsets = (day - 1) * 86400 + hour * 3600 + minute * 60 + second
+    stamps = first_days.astype('datetime64[ns]') + \
+        offsets.astype('timedelta64[s]')
+    stamps[~fixed] = np.datetime64('NaT')
+    times = pd.Series(stamps, index=values.index)
+
+    rest = ~fixed & values.notna().to_numpy()
+    if rest.any():
+        times[rest] = pd.to_datetime(values[rest], format=DT_FORMAT,
+                                     errors='coerce')
+    return times
+
+
+def parse_numbers(values: pd.Series) -> np.ndarray:
+    """ Returns the column as float64, NaN where a value does not parse.
+    Columns the csv parser already typed are only cast; a column left as
+    strings because some value did not parse goes through `pd.to_numeric`.
+    """
+    if pd.api.types.is_numeric_dtype(values) and \
+            not pd.api.types.is_bool_dtype(values):
+        return values.to_numpy(np.float64)
+    return pd.to_numeric(values, errors='coerce').to_numpy(np.float64)
+
+
+def validate_chunk(chunk: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series]:
+    """ Checks and converts a chunk of csv values column by column, with
+    the rules `schemas.DataCreate` applies to a single row plus a few
+    consistency checks: a missing `transaction_id` gets a new uuid4, the
+    timestamp must match `DT_FORMAT`, the numbers must parse, `quantity` must
+    be whole, the text columns must be present and `total_price` must equal
+    `quantity * unit_price` within `config.PRICE_TOLERANCE`.
+
+    Returns the converted chunk, with compact dtypes (int32 quantity,
+    categorical city and product), and aligned with it the reason each row
+    was rejected (None for valid rows).
+    """
+    reasons = np.full(len(chunk), None, dtype=object)
+
+    def reject(mask, reason):
+        reasons[np.asarray(mask) & (reasons == None)] = reason  # noqa: E711
+
+    ids = chunk['transaction_id'].astype(object)
+    missing = ids.isna().to_numpy()
+    if missing.any():
+        ids[missing] = [str(uuid.uuid4()) for _ in range(missing.sum())]
+    reject(~valid_uuids(ids), 'transaction_id')
+
+    times = parse_times(chunk['transaction_time'])
+    reject(times.isna(), 'transaction_time')
+
+    quantity = parse_numbers(chunk['quantity'])
+    reject(np.isnan(quantity) | (np.floor(quantity) != quantity) |
+           (np.abs(quantity) > np.iinfo(np.int32).max), 'quantity')
+    numbers = {}
+    for column in ('unit_price', 'total_price'):
+        numbers[column] = parse_numbers(chunk[column])
+        reject(np.isnan(numbers[column]), column)
+
+    for column in ('product_name', 'delivered_to_city'):
+        reject(chunk[column].isna(), column)
+
+    with np.errstate(invalid='ignore'):
+        reject(~np.isclose(numbers['total_price'],
+                           quantity * numbers['unit_price'],
+                           rtol=1e-9, atol=config.PRICE_TOLERANCE),
+               'total_price != quantity * unit_price')
+
+    valid = reasons == None  # noqa: E711
+    converted = pd.DataFrame({
+        'transaction_id': ids,
+        'transaction_time': times,
+        'product_name': chunk['product_name'].astype('category'),
+        'quantity': np.where(valid, quantity, 0).astype(np.int32),
+        'unit_price': numbers['unit_price'],
+        'total_price': numbers['total_price'],
+        'delivered_to_city': chunk['delivered_to_city'].astype('category'),
+    }, index=chunk.index)
+    return converted, pd.Series(reasons, index=chunk.index)
+
+
+class Quarantine:
+    """ Collects rejected rows, as they were read plus their `row` number and
+    `reason`, in a csv file under `config.QUARANTINE_DIR`. The file is only
+    created once the first row is rejected.
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or config.QUARANTINE_DIR
+        self.path: Optional[str] = None
+        self.rows = 0
+
+    def write(self, rows: pd.DataFrame):
+        if self.path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            name = datetime.utcnow().strftime("%Y%m%dT%H%M%S") + \
+                f"_{uuid.uuid4().hex[:8]}.csv"
+            self.path = os.path.join(self.directory, name)
+        rows.to_csv(self.path, mode='a', index=False,
+                    header=self.rows == 0)
+        self.rows += len(rows)
+
+
+def check_chunk(chunk: pd.DataFrame, first_row: int = 1,
+                quarantine: Optional[Quarantine] = None) -> pd.DataFrame:
+    """ Returns the converted valid rows of `chunk`. Rejected rows, counted
+    from `first_row`, go to `quarantine`, or raise `InvalidRows` without one.
+    """
+    converted, reasons = validate_chunk(chunk)
+    invalid = np.flatnonzero(reasons.notna().to_numpy())
+    if not len(invalid):
+        return converted
+    if quarantine is None:
+        errors = [{"row": first_row + int(position),
+                   "reason": reasons.iloc[position]}
+                  for position in invalid[:MAX_REPORTED_ERRORS]]
+        raise InvalidRows(len(invalid), errors)
+
+    rejected = chunk.iloc[invalid].copy()
+    rejected.insert(0, 'row', first_row + invalid)
+    rejected['reason'] = reasons.iloc[invalid].to_numpy()
+    quarantine.write(rejected)
+    return converted[reasons.isna().to_numpy()]
@@ -14,33 +14,36 @@
 
 from typing import List, Optional
 from uuid import UUID
-from dotenv import load_dotenv
-import os
-from datetime import timedelta
+from datetime import date, timedelta
+import time
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from jose import JWTError
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 
+import orjson
 import uvicorn
 from sqlalchemy.orm import Session
 
-from app.utils import crud, models, schemas
-from app.utils import processing
-from app.utils.schemas import AdminUser, TokenData
-from app.utils.processing import get_users, get_user, \
-    get_password_hash, authenticate_user, create_access_token
+from app.utils import crud, schemas
+from app.utils import processing, pagination, concurrency, config, migrations
+from app.utils import export, database, metrics, profiling, response_cache
+from app.utils import jobs, uploads, validation
+from app.utils.schemas import AdminUser
+from app.utils.processing import get_password_hash, authenticate_user, \
+    create_access_token, decode_access_token
 from app.utils.database import SessionLocal, engine
+from app.utils.concurrency import run_blocking, run_hashing, login_limiter
 
-models.Base.metadata.create_all(bind=engine)
+if config.MIGRATE_ON_STARTUP:
+    migrations.migrate(engine)
 
 
-load_dotenv()
-SECRET_KEY = str(os.getenv("SECRET_KEY"))
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+MAX_BULK_ITEMS = 10000
 
 app = FastAPI()
 
@@ -50,10 +53,71 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag"],
 )
 
+metrics.instrument_engine(engine)
+profiling.instrument_engine(engine)
+metrics.instrument_engine(database.dimension_engine)
+profiling.instrument_engine(database.dimension_engine)
+if database.replica_engine is not None:
+    metrics.instrument_engine(database.replica_engine)
+    profiling.instrument_engine(database.replica_engine)
+
+
+def route_path(request: Request) -> str:
+    """ The path template of the route serving `request`. Middleware runs
+    before routing, which is what would set `scope["route"]`.
+    """
+    for route in app.router.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        metrics.REQUEST_LATENCY.labels(
+            request.method, route_path(request),
+            status_code).observe(time.perf_counter() - start)
+        metrics.REQUESTS_IN_FLIGHT.dec()
+
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    profile = profiling.start(request.headers.get(profiling.PROFILE_HEADER))
+    if profile is None:
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    if profile.timing:
+        response.headers["Server-Timing"] = profile.server_timing(
+            time.perf_counter() - start)
+    if profile.sampled:
+        await run_blocking(profile.dump, route_path(request))
+    return response
+
+
+@app.on_event("startup")
+def start_job_runners():
+    jobs.start()
+
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    concurrency.shutdown()
+    jobs.shutdown()
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="access_token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 # Dependency
@@ -65,6 +129,29 @@ def get_db():
         db.close()
 
 
+def get_read_db(access_token: str = Depends(oauth2_scheme)):
+    """ Session for read-only endpoints, on the replica when one is healthy.
+    """
+    db = database.read_session_for(access_token)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_write_db(access_token: str = Depends(oauth2_scheme)):
+    """ Primary session for endpoints that change data. The client's reads
+    then stay on the primary for `READ_YOUR_WRITES_SECONDS`.
+    """
+    database.note_write(access_token)
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+        database.note_write(access_token)
+
+
 async def get_current_user(access_token: str = Depends(oauth2_scheme),
                            db: Session = Depends(get_db)):
 
@@ -73,18 +160,13 @@ async def get_current_user(access_token: str = Depends(oauth2_scheme),
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(access_token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    with profiling.auth_phase():
+        try:
+            token_data = decode_access_token(access_token)
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
 
-    user_obj = await crud.get_users(db)
-    user_dict = get_users(user_obj)
-    user = get_user(user_dict, username=token_data.username)
+        user = await crud.get_auth_user(db, username=token_data.username)
 
     if user is None:
         raise credentials_exception
@@ -100,17 +182,27 @@ async def get_current_active_user(current_user: AdminUser = Depends(get_current_
 @app.post("/access_token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
                                  db: Session = Depends(get_db)):
-    user_obj = await crud.get_users(db)
-    user_dict = get_users(user_obj)
-    user = authenticate_user(
-        user_dict, form_data.username, form_data.password)
+    if not await login_limiter.acquire():
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many concurrent login attempts, try again later",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        user = await run_hashing(
+            authenticate_user,
+            await crud.get_auth_user(db, username=form_data.username),
+            form_data.password)
+    finally:
+        login_limiter.release()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token_expires = timedelta(
+        minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
@@ -137,7 +229,7 @@ async def create_user(
     db_user = await crud.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="User already registered")
-    password_hashed = get_password_hash(user.password)
+    password_hashed = await run_hashing(get_password_hash, user.password)
     return await crud.create_admin_user(db=db, user=user, password=password_hashed)
 
 
@@ -156,7 +248,7 @@ async def update_user(
     db_user = await crud.get_user_by_username(db, username=user.username)
     if not db_user:
         raise HTTPException(status_code=400, detail="User is not registered")
-    password_hashed = get_password_hash(user.password)
+    password_hashed = await run_hashing(get_password_hash, user.password)
     return await crud.update_admin_user(db=db, user=user, password=password_hashed)
 
 
@@ -187,58 +279,332 @@ async def read_user(user_id: int, db: Session = Depends(get_db),
 
 
 @app.post("/data/upload/")
-async def upload_data(db: Session = Depends(get_db),
+async def upload_data(request: Request,
+                      mode: str = Query(
+                          "append", regex="^(append|upsert|ignore)$"),
+                      invalid: str = Query(
+                          "quarantine", regex="^(quarantine|abort)$"),
+                      db: Session = Depends(get_write_db),
                       current_user: AdminUser = Depends(
                           get_current_active_user)):
-    return await crud.upload_data(db=db)
+    try:
+        if uploads.has_body(request):
+            return await crud.upload_stream(
+                db, uploads.request_body(request), mode=mode,
+                invalid=invalid)
+        return await crud.upload_data(db=db, mode=mode, invalid=invalid)
+    except validation.InvalidRows as e:
+        raise HTTPException(status_code=422,
+                            detail={"message": str(e), "errors": e.errors})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/metrics")
+async def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/db/pool")
+async def db_pool_status(current_user: AdminUser = Depends(
+        get_current_active_user)):
+    return database.pool_status()
 
 
 @app.get("/data/all", response_model=List[schemas.Data])
-async def get_all_data(page: int, entries_per_page: int,
+async def get_all_data(request: Request,
+                       page: int = Query(1, ge=1),
+                       entries_per_page: int = Query(
+                           ..., ge=1, le=pagination.MAX_PAGE_SIZE),
+                       cursor: Optional[str] = None,
+                       format: str = Query(
+                           "json",
+                           regex="^(json|fastjson|columnar|parquet|arrow)$"),
                        current_user: AdminUser = Depends(
-        get_current_active_user), db: Session = Depends(get_db)):
-    return await crud.paginate_data(page, entries_per_page, db)
+        get_current_active_user), db: Session = Depends(get_read_db)):
+    if not cursor and \
+            (page - 1) * entries_per_page > pagination.MAX_OFFSET_ROWS:
+        raise HTTPException(
+            status_code=400,
+            detail="Page is too deep, use the X-Next-Cursor header instead")
+
+    async def build():
+        try:
+            rows, next_cursor = await crud.paginate_data(
+                page, entries_per_page, db, cursor=cursor,
+                orm=format == "json")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+        if format in ("parquet", "arrow"):
+            return Response(
+                content=b"".join(export.stream_arrow(
+                    crud.DATA_FIELDS, [rows], format)),
+                media_type=export.EXPORT_MEDIA_TYPES[format], headers=headers)
+        if format != "json":
+            # returning a Response skips the per-row pydantic validation
+            return Response(
+                content=export.encode_rows(crud.DATA_FIELDS, rows,
+                                           columnar=format == "columnar"),
+                media_type="application/json", headers=headers)
+        # the headers travel with the cached body, so encode it here
+        return Response(
+            content=orjson.dumps(jsonable_encoder(
+                [schemas.Data.from_orm(row) for row in rows])),
+            media_type="application/json", headers=headers)
+
+    return await response_cache.cached(request, db, build)
+
+
+@app.get("/data/stats")
+async def data_stats(
+        request: Request,
+        group_by: str = Query(
+            ..., regex="^(city|product_name|day|month|year)$"),
+        date_start: Optional[date] = None,
+        date_end: Optional[date] = None,
+        city_name: Optional[str] = None,
+        product_name: Optional[str] = None,
+        percentiles: Optional[str] = None,
+        db: Session = Depends(get_read_db),
+        current_user: AdminUser = Depends(
+            get_current_active_user)):
+    try:
+        fractions = [float(p) for p in percentiles.split(",")] \
+            if percentiles else []
+    except ValueError:
+        fractions = [-1]
+    if any(not 0 <= p <= 1 for p in fractions):
+        raise HTTPException(
+            status_code=400,
+            detail="percentiles must be comma separated numbers in [0, 1]")
+    return await response_cache.cached(request, db, lambda: crud.data_stats(
+        db, group_by, date_start=date_start, date_end=date_end,
+        city_name=city_name, product_name=product_name,
+        percentiles=fractions))
+
+
+def parse_fields(fields: Optional[str]):
+    """ Validates a comma separated column projection.
+    """
+    columns = fields.split(",") if fields else crud.DATA_FIELDS
+    unknown = set(columns) - set(crud.DATA_FIELDS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return columns
+
+
+def export_response(db: Session, filters: schemas.DataFilter,
+                    fields: List[str], format: str,
+                    filename: Optional[str] = None):
+    query = crud.export_query(db, filters, fields)
+    filename = filename or f"export.{format}"
+    return StreamingResponse(
+        export.stream_rows(query, fields, format),
+        media_type=export.EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 @app.get("/data/filter_by")
 async def filter_data(
+        request: Request,
         filter_parameter: str,
         save_as_csv: bool = False,
+        format: Optional[str] = Query(
+            None, regex="^(" + "|".join(export.EXPORT_MEDIA_TYPES) + ")$"),
         city_name: Optional[str] = None,
         range_start: Optional[str] = None,
         range_end: Optional[str] = None,
-        db: Session = Depends(get_db),
+        db: Session = Depends(get_read_db),
     current_user: AdminUser = Depends(
             get_current_active_user)):
-    return await crud.filter_by_parameters(filter_parameter, city_name, range_start, range_end, db, save_as_csv)
+    try:
+        filters = crud.parse_filter_parameters(
+            filter_parameter, city_name, range_start, range_end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if filters is None:
+        return "Data not found!"
+    if save_as_csv:
+        format = format or 'csv'
+    if format:
+        return export_response(db, filters, crud.DATA_FIELDS, format,
+                               filename=f"filter_results.{format}")
+    return await response_cache.cached(
+        request, db, lambda: crud.filter_by_parameters(filters, db))
+
+
+@app.get("/data/query")
+async def query_data(
+        request: Request,
+        filters: schemas.DataFilter = Depends(),
+        fields: Optional[str] = None,
+        sort_by: str = Query("transaction_time",
+                             regex="^(" + "|".join(crud.DATA_FIELDS) + ")$"),
+        descending: bool = False,
+        limit: int = Query(1000, ge=1, le=10000),
+        db: Session = Depends(get_read_db),
+        current_user: AdminUser = Depends(
+            get_current_active_user)):
+    fields = parse_fields(fields)
+    return await response_cache.cached(request, db, lambda: crud.query_data(
+        db, filters, fields=fields, sort_by=sort_by, descending=descending,
+        limit=limit))
+
+
+@app.get("/data/export")
+async def export_data(
+        filters: schemas.DataFilter = Depends(),
+        format: str = Query(
+            "csv", regex="^(" + "|".join(export.EXPORT_MEDIA_TYPES) + ")$"),
+        fields: Optional[str] = None,
+        db: Session = Depends(get_read_db),
+        current_user: AdminUser = Depends(
+            get_current_active_user)):
+    return export_response(db, filters, parse_fields(fields), format)
+
+
+@app.post("/jobs/upload/", response_model=schemas.Job,
+          status_code=status.HTTP_202_ACCEPTED)
+async def submit_upload_job(mode: str = Query(
+                                "append", regex="^(append|upsert|ignore)$"),
+                            invalid: str = Query(
+                                "quarantine", regex="^(quarantine|abort)$"),
+                            db: Session = Depends(get_write_db),
+                            current_user: AdminUser = Depends(
+                                get_current_active_user)):
+    params = {"mode": mode, "invalid": invalid}
+    return await jobs.submit(db, 'upload', params, current_user.username)
+
+
+@app.post("/jobs/export/", response_model=schemas.Job,
+          status_code=status.HTTP_202_ACCEPTED)
+async def submit_export_job(
+        filters: schemas.DataFilter = Depends(),
+        format: str = Query(
+            "csv", regex="^(" + "|".join(export.EXPORT_MEDIA_TYPES) + ")$"),
+        fields: Optional[str] = None,
+        db: Session = Depends(get_db),
+        current_user: AdminUser = Depends(
+            get_current_active_user)):
+    params = {"filters": jsonable_encoder(filters), "format": format,
+              "fields": parse_fields(fields)}
+    return await jobs.submit(db, 'export', params, current_user.username)
+
+
+@app.get("/jobs/", response_model=List[schemas.Job])
+async def list_jobs(status: Optional[str] = Query(
+                        None, regex="^(queued|running|succeeded|failed|cancelled)$"),
+                    limit: int = Query(100, ge=1, le=1000),
+                    db: Session = Depends(get_db),
+                    current_user: AdminUser = Depends(
+                        get_current_active_user)):
+    return await jobs.list_jobs(db, status=status, limit=limit)
+
+
+async def get_job_or_404(job_id: str, db: Session):
+    job = await jobs.get_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+async def read_job(job_id: str, db: Session = Depends(get_db),
+                   current_user: AdminUser = Depends(
+                       get_current_active_user)):
+    return await get_job_or_404(job_id, db)
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=schemas.Job)
+async def cancel_job(job_id: str, db: Session = Depends(get_db),
+                     current_user: AdminUser = Depends(
+                         get_current_active_user)):
+    await get_job_or_404(job_id, db)
+    return await jobs.cancel(db, job_id)
+
+
+@app.get("/jobs/{job_id}/result")
+async def download_job_result(job_id: str, db: Session = Depends(get_db),
+                              current_user: AdminUser = Depends(
+                                  get_current_active_user)):
+    job = await get_job_or_404(job_id, db)
+    if job.kind != 'export' or job.status != 'succeeded':
+        raise HTTPException(status_code=409,
+                            detail="Job has no result to download")
+    format = job.params["format"]
+    return FileResponse(jobs.result_path(job),
+                        media_type=export.EXPORT_MEDIA_TYPES[format],
+                        filename=f"export.{format}")
 
 
 @app.post("/data/update/{transaction_id}")
 async def update_data(transaction_id: UUID,
                       data: schemas.DataUpdate,
-                      db: Session = Depends(get_db),
+                      db: Session = Depends(get_write_db),
                       current_user: AdminUser = Depends(
                           get_current_active_user)):
 
-    db_data = await crud.get_data_by_id(db, transaction_id=transaction_id)
-    if not db_data:
+    item = schemas.DataBulkUpdate(transaction_id=transaction_id, **data.dict())
+    result = await crud.bulk_update_data(db=db, items=[item])
+    if result[0]["status"] == "not_found":
         raise HTTPException(status_code=400, detail="Data not found!")
     else:
-        return await crud.update_data(db=db, data=data, transaction_id=transaction_id)
+        return "Data updated successfully"
 
 
 @app.post("/data/delete/")
 async def delete_data(transaction_id: UUID,
-                      db: Session = Depends(get_db),
+                      db: Session = Depends(get_write_db),
                       current_user: AdminUser = Depends(
                           get_current_active_user)
                       ):
 
-    db_data = await crud.get_data_by_id(db, transaction_id=transaction_id)
-    if not db_data:
+    result = await crud.bulk_delete_data(db=db, transaction_ids=[transaction_id])
+    if result[0]["status"] == "not_found":
         raise HTTPException(status_code=400, detail="Data not found")
     else:
-        return await crud.delete_data(db=db, transaction_id=transaction_id)
+        return "Data deleted successfully"
+
+
+@app.post("/data/bulk_update/")
+async def bulk_update_data(items: List[schemas.DataBulkUpdate],
+                           db: Session = Depends(get_write_db),
+                           current_user: AdminUser = Depends(
+                               get_current_active_user)):
+    check_bulk_size(len(items))
+    return await crud.bulk_update_data(db=db, items=items)
+
+
+@app.post("/data/bulk_delete/")
+async def bulk_delete_data(data: schemas.DataBulkDelete,
+                           db: Session = Depends(get_write_db),
+                           current_user: AdminUser = Depends(
+                               get_current_active_user)):
+    check_bulk_size(len(data.transaction_ids))
+    return await crud.bulk_delete_data(db=db,
+                                       transaction_ids=data.transaction_ids)
+
+
+@app.post("/data/retention/")
+async def drop_old_data(before: date, detach: bool = False,
+                        db: Session = Depends(get_write_db),
+                        current_user: AdminUser = Depends(
+                            get_current_active_user)):
+    try:
+        return await crud.drop_data_before(db, before, detach=detach)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_bulk_size(size: int):
+    if size > MAX_BULK_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_ITEMS} items are accepted per request")
 
 
 if __name__ == "__main__":